@@ -4,7 +4,10 @@ An implementation of parser combinators. Includes a use case of a Fortran
 """
 from .parsers import location
 from .parsers import Success, Failure, fail, succeed, parser
-from .parsers import EOF
+from .parsers import Memo, FeedParser, interned, Rule
+from .parsers import ParseContext, ParseBudget, ParseBudgetExceeded
+from .parsers import Profiler
+from .parsers import EOF, operators
 from .parsers import singleton, join, matches, concat
 
 from .tokens import satisfies, one_of, none_of, separated_by
@@ -12,4 +15,7 @@ from .tokens import wildcard, space, spaces, whitespace
 from .tokens import letter, word, digit, digits
 from .tokens import alphanumeric, alphanumerics
 from .tokens import exact, liberal
-from .tokens import regex
+from .tokens import regex, span
+from .tokens import Lexer, Token, one_of_tags, none_of_tags, switch_tag
+from .tokens import space_chars, letter_chars, digit_chars, alphanumeric_chars
+from .tokens import is_space, is_letter, is_digit, is_alphanumeric
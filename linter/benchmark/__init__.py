@@ -0,0 +1,4 @@
+"""
+Microbenchmarks for the parser combinators. Run them with
+``python -m linter.benchmark``.
+"""
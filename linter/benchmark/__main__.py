@@ -0,0 +1,4 @@
+""" Run the combinator benchmarks. """
+from .combinators import main
+
+main()
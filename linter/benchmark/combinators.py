@@ -0,0 +1,277 @@
+"""
+Throughput and allocation benchmarks for the primitive parsers and the
+combinators. Every benchmark parses synthetic inputs of increasing size, so
+that work growing faster than the input shows up as a falling rate of items
+per second. Results can be saved as JSON and compared with an earlier run.
+"""
+import gc
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from functools import reduce
+from timeit import default_timer
+
+from .. import exact, satisfies, one_of, separated_by, regex
+from .. import letter, digit, digits
+
+#: input sizes, in repetitions of the unit of input of each benchmark
+SIZES = (100, 1000, 10000)
+
+#: numbers of alternatives for the choice benchmarks
+ALTERNATIVES = (2, 8, 32)
+
+
+class Benchmark(object):
+    """
+    A parser to measure and the unit of input it is applied to, which is
+    repeated to make inputs of the requested sizes.
+    """
+    def __init__(self, name, prsr, unit):
+        self.name = name
+        self.prsr = prsr
+        self.unit = unit
+
+    def text(self, size):
+        """ An input of `size` units. """
+        if callable(self.unit):
+            return self.unit(size)
+        return self.unit * size
+
+    def check(self, text):
+        """ Make sure the parser consumes all of `text`. """
+        end = self.prsr.scan(text).end
+        if end != len(text):
+            raise AssertionError("{} stopped at {} of {}"
+                                 .format(self.name, end, len(text)))
+
+
+def keyword_cycle(count):
+    """ An input function cycling through `count` keywords. """
+    def text(size):
+        """ `size` keywords. """
+        return "".join("k{};".format(index % count) for index in range(size))
+    return text
+
+
+def benchmarks():
+    """ The list of all benchmarks. """
+    result = [
+        Benchmark("exact", exact("ab").many(), "ab"),
+        Benchmark("satisfies", satisfies(str.isdigit, "digit").many(), "7"),
+        Benchmark("many", one_of("ab").many(), "a"),
+        Benchmark("between", (one_of("ab") * 4).many(), "abba"),
+        Benchmark("sequence", (letter + digit + exact(";")).many(), "a1;"),
+        Benchmark("separated_by", separated_by(digits, exact(",")),
+                  lambda size: ",".join(["12"] * size)),
+        Benchmark("regex", regex("[a-z]+[0-9]").many(), "abc1"),
+        Benchmark("map", (one_of("ab") // str.upper).many(), "b"),
+        Benchmark("label", (one_of("ab") % "letter").many(), "b"),
+    ]
+
+    for count in ALTERNATIVES:
+        alternatives = [exact("k{};".format(index))
+                        for index in range(count)]
+        result.append(Benchmark("choice-{}".format(count),
+                                reduce(lambda x, y: x | y,
+                                       alternatives).many(),
+                                keyword_cycle(count)))
+
+    return result
+
+
+def rate(prsr, text, min_time):
+    """
+    The number of times per second `prsr` parses `text`: the best of three
+    rounds, each repeating the parse for at least `min_time` seconds.
+    """
+    number = 1
+    while True:
+        elapsed = timed(prsr, text, number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = min([elapsed] + [timed(prsr, text, number) for _ in range(2)])
+    return number / best
+
+
+def timed(prsr, text, number):
+    """ The time `number` parses of `text` take. """
+    scan = prsr.scan
+    started = default_timer()
+    for _ in range(number):
+        scan(text)
+    return default_timer() - started
+
+
+def allocations(prsr, text):
+    """
+    The number of garbage collected objects a parse of `text` creates that
+    are still alive when it returns, its result included. Python 2 has no
+    allocation hooks, so objects freed during the parse are not counted.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        result = prsr.scan(text)
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+
+    del result
+    return after - before
+
+
+def run(selected, sizes, min_time):
+    """
+    Measure the `selected` benchmarks on inputs of each of the `sizes`. The
+    results are keyed by benchmark name, then by size as a string, as they
+    are in the JSON files.
+    """
+    results = {}
+
+    for bench in selected:
+        results[bench.name] = {}
+        for size in sizes:
+            text = bench.text(size)
+            bench.check(text)
+            results[bench.name][str(size)] = {
+                "ops_per_sec": rate(bench.prsr, text, min_time),
+                "allocations": allocations(bench.prsr, text)}
+
+    return results
+
+
+def superlinear(results, factor):
+    """
+    The names of the benchmarks for which the time per unit of input grows
+    by more than `factor` from the smallest size to the largest.
+    """
+    result = []
+
+    for name, by_size in sorted(results.items()):
+        sizes = sorted(by_size, key=int)
+        if len(sizes) < 2:
+            continue
+
+        def per_unit(size):
+            """ The time to parse one unit at `size`. """
+            return 1.0 / (by_size[size]["ops_per_sec"] * int(size))
+
+        if per_unit(sizes[-1]) > factor * per_unit(sizes[0]):
+            result.append(name)
+
+    return result
+
+
+def regressions(previous, current, threshold):
+    """
+    Descriptions of the measurements in `current` that are worse than the
+    same ones in `previous` by more than a factor of `threshold`.
+    """
+    result = []
+
+    for name, by_size in sorted(current.items()):
+        for size, now in sorted(by_size.items(), key=lambda item: int(item[0])):
+            before = previous.get(name, {}).get(size)
+            if before is None:
+                continue
+
+            if before["ops_per_sec"] > threshold * now["ops_per_sec"]:
+                result.append("{} at {}: {:.0f} ops/sec, was {:.0f}"
+                              .format(name, size, now["ops_per_sec"],
+                                      before["ops_per_sec"]))
+            if now["allocations"] > threshold * max(before["allocations"], 1):
+                result.append("{} at {}: {} allocations, was {}"
+                              .format(name, size, now["allocations"],
+                                      before["allocations"]))
+
+    return result
+
+
+def report(results):
+    """ A table of the measurements. """
+    lines = ["{:<14} {:>7} {:>12} {:>12} {:>11}"
+             .format("benchmark", "size", "ops/sec", "units/sec",
+                     "allocations")]
+
+    for name, by_size in sorted(results.items()):
+        for size, entry in sorted(by_size.items(),
+                                  key=lambda item: int(item[0])):
+            lines.append("{:<14} {:>7} {:>12.1f} {:>12.0f} {:>11}"
+                         .format(name, size, entry["ops_per_sec"],
+                                 entry["ops_per_sec"] * int(size),
+                                 entry["allocations"]))
+
+    return "\n".join(lines)
+
+
+def _argument_parser_():
+    arg_parser = ArgumentParser(description=__doc__)
+    arg_parser.add_argument("names", nargs="*", metavar="benchmark",
+                            help="benchmarks to run (default: all)")
+    arg_parser.add_argument("--sizes", type=int, nargs="+",
+                            default=list(SIZES),
+                            help="input sizes, in units of input")
+    arg_parser.add_argument("--min-time", type=float, default=0.1,
+                            help="minimum seconds per timing round")
+    arg_parser.add_argument("--save", metavar="FILE",
+                            help="write the results to a JSON file")
+    arg_parser.add_argument("--compare", metavar="FILE",
+                            help="flag regressions against a JSON file "
+                            "from an earlier run")
+    arg_parser.add_argument("--threshold", type=float, default=1.25,
+                            help="slowdown or allocation growth factor "
+                            "counted as a regression")
+    arg_parser.add_argument("--superlinear", type=float, default=3.0,
+                            help="growth factor of the time per unit of "
+                            "input from the smallest to the largest size "
+                            "counted as superlinear")
+    return arg_parser
+
+
+def main():
+    """
+    Run the benchmarks and print a table of the results. Exits with status 1
+    if a comparison with an earlier run finds regressions.
+    """
+    arg_parser = _argument_parser_()
+    args = arg_parser.parse_args()
+
+    available = benchmarks()
+    names = [bench.name for bench in available]
+    for name in args.names:
+        if name not in names:
+            arg_parser.error("unknown benchmark {!r}, choose from {}"
+                             .format(name, ", ".join(names)))
+
+    selected = [bench for bench in available
+                if not args.names or bench.name in args.names]
+    results = run(selected, args.sizes, args.min_time)
+
+    print report(results)
+
+    for name in superlinear(results, args.superlinear):
+        print "superlinear: {}".format(name)
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump({"python": platform.python_version(),
+                       "implementation": platform.python_implementation(),
+                       "results": results},
+                      output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            found = regressions(json.load(previous)["results"], results,
+                                args.threshold)
+        for line in found:
+            print "regression: {}".format(line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,549 @@
+"""
+Compilation of parser graphs into specialized Python functions.
+"""
+import hashlib
+import imp
+import os
+
+from .parsers import AbstractParser, Failure, BYTE_TYPES
+
+
+#: sub-parsers nested deeper than this get a function of their own
+MAX_INDENT = 40
+
+#: loops nested deeper than this get a function of their own, as Python
+#: limits the number of statically nested blocks
+MAX_LOOPS = 10
+
+
+def literal(value):
+    """ Whether `value` can be written into the source as it is. """
+    return type(value) in (str, int, bool, type(None))
+
+
+class Compiler(object):
+    """
+    Generates the source code of a module with a function `bind`. Given
+    the constants the code refers to, `bind` returns a function
+    implementing `root` with the internal protocol of `_scan`.
+
+    Sub-parsers are inlined into the code of their parents, except when
+    they are shared, nested too deeply, or implemented by opaque parsing
+    functions; the latter are applied through their own `_scan`.
+    """
+    def __init__(self, root):
+        self.root = root
+
+        self.consts = []
+        self.const_names = {}
+
+        self.names = {}
+        self.pending = []
+        self.counter = 0
+
+        self.refs = {}
+        self.count_refs(root)
+        self.refs[id(root)] += 1
+
+    def count_refs(self, node):
+        """ Count how many times each sub-parser is referred to. """
+        key = id(node)
+        self.refs[key] = self.refs.get(key, 0) + 1
+
+        if self.refs[key] == 1:
+            for child in children(node):
+                self.count_refs(child)
+
+    def const(self, value):
+        """ An expression for `value` in the generated code. """
+        if literal(value):
+            return repr(value)
+
+        key = id(value)
+        if key not in self.const_names:
+            self.const_names[key] = "c{}".format(len(self.consts))
+            self.consts.append(value)
+        return self.const_names[key]
+
+    def fresh(self):
+        """ A fresh suffix for local variable names. """
+        self.counter += 1
+        return str(self.counter)
+
+    def function(self, node):
+        """ The name of the function implementing `node`. """
+        key = id(node)
+        if key not in self.names:
+            self.names[key] = "p{}".format(len(self.names))
+            self.pending.append(node)
+        return self.names[key]
+
+    def source(self):
+        """ The generated source code. """
+        self.function(self.root)
+
+        functions = []
+        while self.pending:
+            node = self.pending.pop(0)
+
+            out = ["    def {}(context, start):".format(self.function(node)),
+                   "        text = context.text",
+                   "        fail = context.fail"]
+            self.inline(node, "start", "result", out, " " * 8, 0, set())
+            out.append("        return result")
+            functions.append("\n".join(out))
+
+        lines = ["def bind(consts, Failure):"]
+        if self.consts:
+            lines.append("    {}, = consts".format(
+                ", ".join("c{}".format(index)
+                          for index in range(len(self.consts)))))
+        lines.extend(functions)
+        lines.append("    return p0")
+
+        return "\n".join(lines) + "\n"
+
+    def emit(self, node, pos, result, out, ind, loops, stack):
+        """
+        Append code at indentation `ind` to `out` that applies `node` at
+        `pos` and stores the outcome in `result`.
+        """
+        if children(node) and (self.refs[id(node)] > 1 or id(node) in stack or
+                               len(ind) > MAX_INDENT or loops > MAX_LOOPS):
+            out.append("{}{} = {}(context, {})"
+                       .format(ind, result, self.function(node), pos))
+        else:
+            self.inline(node, pos, result, out, ind, loops, stack)
+
+    def inline(self, node, pos, result, out, ind, loops, stack):
+        """ Like `emit`, but never calls a separate function. """
+        method = getattr(self, "emit_" + type(node).__name__, None)
+
+        if method is None:
+            out.append("{}{} = {}._scan(context, {})"
+                       .format(ind, result, self.const(node), pos))
+        else:
+            stack = stack | set([id(node)])
+            method(node, pos, result, out, ind, loops, stack)
+
+    def emit_ExactParser(self, node, pos, result, out, ind, *_):
+        """ Compare a slice of the input with the string. """
+        string = node.string
+        segment = "text[{0}:{0} + {1}]".format(pos, len(string))
+
+        if node.ignore_case and string.upper() != string:
+            condition = ("(context.folded.startswith({1}, {0}) "
+                         "if context.folded is not None "
+                         "else {2}.lower() == {1})"
+                         .format(pos, self.const(string), segment))
+        else:
+            condition = "{} == {}".format(segment, self.const(string))
+
+        out.append("{}if {}:".format(ind, condition))
+        out.append("{}    {} = ({} + {}, {})".format(ind, result, pos,
+                                                     len(string),
+                                                     self.const(string)))
+        self.emit_else_fail(node.expected, pos, result, out, ind,
+                            "{} + {} > len(text)".format(pos, len(string)))
+
+    def emit_OneOfParser(self, node, pos, result, out, ind, *_):
+        """ Look up the next character. """
+        out.append("{0}if {1} < len(text) and text[{1}] in {2}:"
+                   .format(ind, pos, self.const(node.chars)))
+        out.append("{0}    {1} = ({2} + 1, text[{2}])"
+                   .format(ind, result, pos))
+        self.emit_else_fail(node.expected, pos, result, out, ind,
+                            "{} >= len(text)".format(pos))
+
+    def emit_NoneOfParser(self, node, pos, result, out, ind, *_):
+        """ Look up the next character. """
+        out.append("{0}if {1} < len(text) and text[{1}] not in {2}:"
+                   .format(ind, pos, self.const(node.chars)))
+        out.append("{0}    {1} = ({2} + 1, text[{2}])"
+                   .format(ind, result, pos))
+        self.emit_else_fail(node.expected, pos, result, out, ind,
+                            "{} >= len(text)".format(pos))
+
+    def emit_SatisfiesParser(self, node, pos, result, out, ind, *_):
+        """ Test the next character. """
+        out.append("{0}if {1} < len(text) and {2}(text[{1}]):"
+                   .format(ind, pos, self.const(node.predicate)))
+        out.append("{0}    {1} = ({2} + 1, text[{2}])"
+                   .format(ind, result, pos))
+        self.emit_else_fail(node.expected, pos, result, out, ind,
+                            "{} >= len(text)".format(pos))
+
+    def emit_SpanParser(self, node, pos, result, out, ind, *_):
+        """
+        Match the run of characters in byte input, leave other input to the
+        parser.
+        """
+        out.append("{}if not isinstance(text, {}):".format(
+            ind, self.const(BYTE_TYPES)))
+        out.append("{}    {} = {}.scan_items(context, {})"
+                   .format(ind, result, self.const(node), pos))
+        out.append("{}else:".format(ind))
+        ind += "    "
+
+        match = "m" + self.fresh()
+        out.append("{}{} = {}(text, {})"
+                   .format(ind, match, self.const(node.exp.match), pos))
+        out.append("{}if {}:".format(ind, match))
+        self.emit_hit_end("{}.end() == len(text)".format(match), out,
+                          ind + "    ")
+        out.append("{0}    {1} = ({2}.end(), {2}.group())"
+                   .format(ind, result, match))
+
+        if node.minimum is None:
+            at_end = "True"
+        else:
+            at_end = "{} + {} > len(text)".format(pos, node.minimum)
+        self.emit_else_fail(node.expected, pos, result, out, ind, at_end)
+
+    def emit_RegexParser(self, node, pos, result, out, ind, *_):
+        """ Match the regular expression. """
+        match = "m" + self.fresh()
+        out.append("{}{} = {}(text, {})"
+                   .format(ind, match, self.const(node.exp.match), pos))
+        out.append("{}if {}:".format(ind, match))
+        self.emit_hit_end("{}.end() == len(text)".format(match), out,
+                          ind + "    ")
+        out.append("{0}    {1} = ({2}.end(), {2})".format(ind, result, match))
+        self.emit_else_fail(node.exp.pattern, pos, result, out, ind, "True")
+
+    def emit_else_fail(self, expected, pos, result, out, ind, at_end=None):
+        """
+        Record a failure in the ``else`` branch, noting that the end of the
+        input was hit if the condition `at_end` holds.
+        """
+        out.append("{}else:".format(ind))
+        if at_end is not None:
+            self.emit_hit_end(at_end, out, ind + "    ")
+        out.append("{}    {} = fail({}, {})"
+                   .format(ind, result, pos, self.const(expected)))
+
+    def emit_hit_end(self, condition, out, ind):
+        """ Note in the context that the end was hit if `condition` holds. """
+        if condition == "True":
+            out.append("{}context.hit_end = True".format(ind))
+        else:
+            out.append("{}if {}:".format(ind, condition))
+            out.append("{}    context.hit_end = True".format(ind))
+
+    def emit_SucceedParser(self, node, pos, result, out, ind, *_):
+        """ Succeed with the constant. """
+        out.append("{}{} = ({}, {})".format(ind, result, pos,
+                                            self.const(node.value)))
+
+    def emit_FailParser(self, node, pos, result, out, ind, *_):
+        """ Fail unconditionally. """
+        out.append("{}{} = fail({}, {})".format(ind, result, pos,
+                                                self.const(node.expected)))
+
+    def emit_EOFParser(self, node, pos, result, out, ind, *_):
+        """ Check for the end of input. """
+        out.append("{}if {} >= len(text):".format(ind, pos))
+        out.append("{}    context.hit_end = True".format(ind))
+        out.append("{}    {} = ({}, None)".format(ind, result, pos))
+        self.emit_else_fail(node.expected, pos, result, out, ind)
+
+    def emit_LabelParser(self, node, pos, result, out, ind, loops, stack):
+        """ Relabel the failure. """
+        self.emit(node.this, pos, result, out, ind, loops, stack)
+        out.append("{}if {} is None:".format(ind, result))
+        out.append("{}    fail({}, {})".format(ind, pos,
+                                               self.const(node.expected)))
+
+    def emit_MapParser(self, node, pos, result, out, ind, loops, stack):
+        """ Apply the function on success. """
+        self.emit(node.this, pos, result, out, ind, loops, stack)
+        out.append("{}if {} is not None:".format(ind, result))
+        out.append("{0}    {1} = ({1}[0], {2}({1}[1]))"
+                   .format(ind, result, self.const(node.function)))
+
+    def emit_GuardParser(self, node, pos, result, out, ind, loops, stack):
+        """ Test the predicate on success. """
+        self.emit(node.this, pos, result, out, ind, loops, stack)
+        out.append("{}if {} is not None and not {}({}[1]):"
+                   .format(ind, result, self.const(node.predicate), result))
+        out.append("{}    {} = fail({}, {})"
+                   .format(ind, result, pos, self.const(node.desc)))
+
+    def emit_MemoParser(self, node, pos, result, out, ind, loops, stack):
+        """ Look up the memo table before applying the parser. """
+        if node.memo is None:
+            self.emit_context_memo(node, pos, result, out, ind, loops, stack)
+            return
+
+        suffix = self.fresh()
+        key, entry = "k" + suffix, "n" + suffix
+        memo = self.const(node.memo)
+
+        out.append("{}{} = ({}, id(text), {})"
+                   .format(ind, key, self.const(node.this), pos))
+        out.append("{}{} = {}.lookup({})".format(ind, entry, memo, key))
+        out.append("{}if {} is None:".format(ind, entry))
+        self.emit(node.this, pos, result, out, ind + "    ", loops, stack)
+        out.append("{}    {}.store({}, (text, {}, context.failure, "
+                   "context.committed))".format(ind, memo, key, result))
+        out.append("{}else:".format(ind))
+        out.append("{}    {} = {}[1]".format(ind, result, entry))
+        out.append("{}    if {} is None:".format(ind, result))
+        out.append("{}        context.failure = {}[2]".format(ind, entry))
+        out.append("{}        context.committed = {}[3]".format(ind, entry))
+
+    def emit_context_memo(self, node, pos, result, out, ind, loops, stack):
+        """ Look up the memo of the context before applying the parser. """
+        suffix = self.fresh()
+        table, key, entry = "t" + suffix, "k" + suffix, "n" + suffix
+
+        out.append("{}{} = context.memo".format(ind, table))
+        out.append("{}if {} is None:".format(ind, table))
+        out.append("{0}    {1} = context.memo = {{}}".format(ind, table))
+        out.append("{}{} = ({}, {})"
+                   .format(ind, key, self.const(node.this), pos))
+        out.append("{}{} = {}.get({})".format(ind, entry, table, key))
+        out.append("{}if {} is None:".format(ind, entry))
+        self.emit(node.this, pos, result, out, ind + "    ", loops, stack)
+        out.append("{}    {}[{}] = ({}, context.failure, context.committed)"
+                   .format(ind, table, key, result))
+        out.append("{}else:".format(ind))
+        out.append("{}    {} = {}[0]".format(ind, result, entry))
+        out.append("{}    if {} is None:".format(ind, result))
+        out.append("{}        context.failure = {}[1]".format(ind, entry))
+        out.append("{}        context.committed = {}[2]".format(ind, entry))
+
+    def emit_CommitParser(self, node, pos, result, out, ind, loops, stack):
+        """ Mark a failure as committed, release the memo on success. """
+        self.emit(node.this, pos, result, out, ind, loops, stack)
+        out.append("{}if {} is None:".format(ind, result))
+        out.append("{}    context.committed = True".format(ind))
+        out.append("{}elif context.memo:".format(ind))
+        out.append("{}    context.release({})".format(ind, pos))
+
+    def emit_Rule(self, node, pos, result, out, ind, loops, stack):
+        """
+        Apply the definition. Recursive references end up in functions of
+        their own, as the rule is on the stack.
+        """
+        self.emit_step(node, pos, out, ind)
+        self.emit(node.definition(), pos, result, out, ind, loops, stack)
+
+    def emit_IgnoreParser(self, node, pos, result, out, ind, loops, stack):
+        """ Apply both parsers, keep the second result. """
+        first = "r" + self.fresh()
+        self.emit(node.this, pos, first, out, ind, loops, stack)
+        out.append("{}if {} is None:".format(ind, first))
+        out.append("{}    {} = None".format(ind, result))
+        out.append("{}else:".format(ind))
+        self.emit(node.that, first + "[0]", result, out, ind + "    ",
+                  loops, stack)
+
+    def emit_IgnoreFollowingParser(self, node, pos, result, out, ind,
+                                   loops, stack):
+        """ Apply both parsers, keep the first result. """
+        suffix = self.fresh()
+        first, end = "r" + suffix, "e" + suffix
+        self.emit(node.this, pos, first, out, ind, loops, stack)
+        out.append("{}{} = None".format(ind, result))
+        out.append("{}if {} is not None:".format(ind, first))
+        out.append("{}    {} = {}[0]".format(ind, end, first))
+        self.emit(node.that, end, result, out, ind + "    ", loops, stack)
+        out.append("{}    if {} is not None:".format(ind, result))
+        out.append("{0}        {1} = ({1}[0], {2}[1])"
+                   .format(ind, result, first))
+
+    def emit_SequenceParser(self, node, pos, result, out, ind, loops, stack):
+        """
+        Apply the parsers one after another. Each one is only applied if
+        the previous ones succeeded.
+        """
+        suffix = self.fresh()
+        end, value, step = "e" + suffix, "v" + suffix, "r" + suffix
+
+        out.append("{}{} = None".format(ind, result))
+        self.emit(node.parsers[0], pos, step, out, ind, loops, stack)
+        out.append("{}if {} is not None:".format(ind, step))
+        out.append("{}    {}, {} = {}".format(ind, end, value, step))
+        out.append("{}    if isinstance({}, list):".format(ind, value))
+        out.append("{0}        {1} = list({1})".format(ind, value))
+
+        for this in node.parsers[1:]:
+            self.emit(this, end, step, out, ind + "    ", loops, stack)
+            out.append("{}if {} is not None:".format(ind, step))
+            out.append("{}    {} = {}[0]".format(ind, end, step))
+            out.append("{}    {} += {}[1]".format(ind, value, step))
+
+        out.append("{}    {} = ({}, {})".format(ind, result, end, value))
+
+    def emit_alternatives(self, node, pos, result, out, ind, loops, stack,
+                          backtrack):
+        """
+        Try the alternatives of a choice in turn, skipping those whose
+        FIRST sets rule them out, and stopping at a committed failure.
+        """
+        suffix = self.fresh()
+        char, stop = "h" + suffix, "s" + suffix
+        self.emit_step(node, pos, out, ind)
+        out.append("{0}{1} = text[{2}] if {2} < len(text) else None"
+                   .format(ind, char, pos))
+        out.append("{}{} = None".format(ind, result))
+        out.append("{}{} = False".format(ind, stop))
+
+        if backtrack:
+            committed = "context.committed"
+        else:
+            committed = ("(context.committed or context.failure[0] != {})"
+                         .format(pos))
+
+        for index, this in enumerate(node.parsers):
+            first, nullable = this.first()
+
+            conditions = []
+            if index > 0:
+                conditions.append("{} is None and not {}"
+                                  .format(result, stop))
+            if first is not None and not nullable:
+                # FIRST sets do not list the unicode characters that spans
+                # may take, see `dispatch`
+                conditions.append("({0} in {1} or type({0}) is unicode)"
+                                  .format(char, self.const(first)))
+
+            out.append("{}if {}:".format(ind, " and ".join(conditions) or
+                                         "True"))
+            self.emit(this, pos, result, out, ind + "    ", loops, stack)
+            out.append("{}    if {} is None and {}:"
+                       .format(ind, result, committed))
+            out.append("{}        context.committed = False".format(ind))
+            out.append("{}        {} = True".format(ind, stop))
+            out.append("{}    elif {} is None and context.budget is not None:"
+                       .format(ind, result))
+            out.append("{}        context.budget.backtrack(context, {})"
+                       .format(ind, pos))
+
+        out.append("{}if {} is None and not {}:".format(ind, result, stop))
+        out.append("{}    fail({}, {})".format(ind, pos,
+                                               self.const(node.expected)))
+
+    def emit_step(self, node, pos, out, ind):
+        """ Count the application of `node` against the budget, if any. """
+        out.append("{}if context.budget is not None:".format(ind))
+        out.append("{}    context.budget.step({}, context, {})"
+                   .format(ind, self.const(node), pos))
+
+    def emit_ChoiceParser(self, node, pos, result, out, ind, loops, stack):
+        """ Try the alternatives, backtracking. """
+        self.emit_alternatives(node, pos, result, out, ind, loops, stack,
+                               True)
+
+    def emit_ChoiceNoBacktrackParser(self, node, pos, result, out, ind,
+                                     loops, stack):
+        """ Try the alternatives, without backtracking. """
+        self.emit_alternatives(node, pos, result, out, ind, loops, stack,
+                               False)
+
+    def emit_BetweenParser(self, node, pos, result, out, ind, loops, stack):
+        """ A loop in place of repeated application. """
+        suffix = self.fresh()
+        values, current, step = "l" + suffix, "e" + suffix, "r" + suffix
+
+        self.emit_step(node, pos, out, ind)
+        out.append("{}{} = []".format(ind, values))
+        out.append("{}{} = {}".format(ind, current, pos))
+        if node.maximum == float('inf'):
+            out.append("{}while True:".format(ind))
+        else:
+            out.append("{}while len({}) < {}:"
+                       .format(ind, values, self.const(node.maximum)))
+        self.emit(node.this, current, step, out, ind + "    ",
+                  loops + 1, stack)
+        out.append("{}    if {} is None:".format(ind, step))
+        out.append("{}        break".format(ind))
+        out.append("{}    {} = {}[0]".format(ind, current, step))
+        out.append("{}    {}.append({}[1])".format(ind, values, step))
+        out.append("{}if len({}) >= {} and not context.committed:"
+                   .format(ind, values, self.const(node.minimum)))
+        out.append("{}    {} = ({}, {})".format(ind, result, current, values))
+        out.append("{}else:".format(ind))
+        out.append("{}    {} = None".format(ind, result))
+
+
+def children(node):
+    """ The sub-parsers of `node` that can be compiled along with it. """
+    if type(node).__name__ in ["ParsingFunction", "CompiledParser"]:
+        return []
+
+    result = []
+    for attr in ["this", "that"]:
+        child = getattr(node, attr, None)
+        if isinstance(child, AbstractParser):
+            result.append(child)
+
+    result.extend(getattr(node, "parsers", []))
+    return result
+
+
+class CompiledParser(AbstractParser):
+    """
+    Runs the function `function` generated from `prsr`, with its module
+    cached in `cache_dir` if given. Pickled, it is compiled again.
+    """
+    def __init__(self, prsr, function, cache_dir=None):
+        self.prsr = prsr
+        self.function = function
+        self.cache_dir = cache_dir
+        self.expected = prsr.expected
+
+    def _scan(self, context, start):
+        return self.function(context, start)
+
+    def first(self):
+        return self.prsr.first()
+
+    def literal_prefix(self):
+        return self.prsr.literal_prefix()
+
+    def __reduce__(self):
+        # generated code does not pickle, so it is generated again
+        return compile_parser, (self.prsr, self.cache_dir)
+
+
+def load_source(source, cache_dir):
+    """
+    Load the module generated as `source`. With a `cache_dir`, the module
+    is stored there under the hash of its source, so that its byte code is
+    cached too.
+    """
+    if cache_dir is None:
+        namespace = {}
+        exec(compile(source, "<compiled parser>", "exec"), namespace)
+        return namespace["bind"]
+
+    name = "parser_" + hashlib.sha1(source).hexdigest()
+    path = os.path.join(cache_dir, name + ".py")
+
+    if not os.path.exists(path):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # write, then rename, so that no reader sees a partial file
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "w") as module_file:
+            module_file.write(source)
+        os.rename(temporary, path)
+
+    return imp.load_source(name, path).bind
+
+
+def compile_parser(prsr, cache_dir=None):
+    """
+    Compile `prsr` into an equivalent parser that runs generated Python
+    code, with local variables, inlined character tests and loops.
+    Parsing functions are applied as they are. The generated modules are
+    cached in `cache_dir` if given.
+    """
+    compiler = Compiler(prsr)
+    source = compiler.source()
+    bind = load_source(source, cache_dir)
+
+    return CompiledParser(prsr, bind(compiler.consts, Failure), cache_dir)
@@ -0,0 +1,299 @@
+"""
+Evaluation of parser graphs with an explicit stack instead of recursion.
+"""
+from .parsers import AbstractParser, LabelParser, MapParser, GuardParser
+from .parsers import BetweenParser, MemoParser, IgnoreParser
+from .parsers import IgnoreFollowingParser, SequenceParser, ChoiceParser
+from .parsers import ChoiceNoBacktrackParser, CommitParser, Rule, dispatch
+from .tokens import SwitchTagParser
+
+
+# Each combinator is applied by a generator, which yields ``(parser,
+# position)`` to have a sub-parser applied and is sent its outcome. The last
+# thing it yields is ``(None, outcome)``, its own outcome. Parsers without a
+# generator, primitive parsers and parsing functions, are applied through
+# their `_scan`.
+
+def scan_label(node, context, start):
+    """ Relabel the failure. """
+    result = yield node.this, start
+    if result is None:
+        context.fail(start, node.expected)
+    yield None, result
+
+
+def scan_map(node, context, start):
+    """ Apply the function on success. """
+    result = yield node.this, start
+    if result is not None:
+        result = result[0], node.function(result[1])
+    yield None, result
+
+
+def scan_guard(node, context, start):
+    """ Test the predicate on success. """
+    result = yield node.this, start
+    if result is not None and not node.predicate(result[1]):
+        result = context.fail(start, node.desc)
+    yield None, result
+
+
+def scan_between(node, context, start):
+    """ Apply the parser repeatedly. """
+    if context.budget is not None:
+        context.budget.step(node, context, start)
+
+    values = []
+    current = start
+
+    while len(values) < node.maximum:
+        result = yield node.this, current
+
+        if result is None:
+            if len(values) >= node.minimum and not context.committed:
+                break
+            yield None, None
+            return
+
+        current, value = result
+        values.append(value)
+
+    yield None, (current, values)
+
+
+def scan_memo(node, context, start):
+    """ Look up the memo table before applying the parser. """
+    if node.memo is None:
+        table = context.memo
+        if table is None:
+            table = context.memo = {}
+
+        key = (node.this, start)
+        entry = table.get(key)
+
+        if entry is None:
+            result = yield node.this, start
+            table[key] = (result, context.failure, context.committed)
+        else:
+            result, failure, committed = entry
+            if result is None:
+                context.failure = failure
+                context.committed = committed
+
+        yield None, result
+        return
+
+    text = context.text
+    key = (node.this, id(text), start)
+    entry = node.memo.lookup(key)
+
+    if entry is None:
+        result = yield node.this, start
+        node.memo.store(key, (text, result, context.failure,
+                              context.committed))
+    else:
+        _, result, failure, committed = entry
+        if result is None:
+            context.failure = failure
+            context.committed = committed
+
+    yield None, result
+
+
+def scan_ignore(node, context, start):
+    """ Apply both parsers, keep the second result. """
+    result = yield node.this, start
+    if result is not None:
+        result = yield node.that, result[0]
+    yield None, result
+
+
+def scan_ignore_following(node, context, start):
+    """ Apply both parsers, keep the first result. """
+    result = yield node.this, start
+    if result is not None:
+        end, value = result
+        result = yield node.that, end
+        if result is not None:
+            result = result[0], value
+    yield None, result
+
+
+def scan_sequence(node, context, start):
+    """ Apply the parsers one after another. """
+    parsers = node.parsers
+
+    result = yield parsers[0], start
+    if result is None:
+        yield None, None
+        return
+
+    end, value = result
+    if isinstance(value, list):
+        # do not extend a list that may be shared, say, by a memo table
+        value = list(value)
+
+    for index in range(1, len(parsers)):
+        result = yield parsers[index], end
+        if result is None:
+            yield None, None
+            return
+
+        end, following = result
+        value += following
+
+    yield None, (end, value)
+
+
+def scan_choice(node, context, start):
+    """
+    Try the alternatives in turn. Choices without backtracking give up
+    once an alternative consumed input.
+    """
+    budget = context.budget
+    if budget is not None:
+        budget.step(node, context, start)
+
+    backtrack = isinstance(node, ChoiceParser)
+    parsers = dispatch(node, context, start)
+
+    for this in parsers:
+        result = yield this, start
+        if result is not None:
+            yield None, result
+            return
+
+        if context.committed or (not backtrack and
+                                 context.failure[0] != start):
+            context.committed = False
+            yield None, None
+            return
+
+        if budget is not None:
+            budget.backtrack(context, start)
+
+    if len(parsers) < len(node.parsers):
+        yield None, context.fail(start, node.expected)
+        return
+
+    # the alternatives have already been tracked
+    context.failure = (start, node.expected)
+    yield None, None
+
+
+def scan_commit(node, context, start):
+    """ Mark a failure as committed, release the memo on success. """
+    result = yield node.this, start
+    if result is None:
+        context.committed = True
+    elif context.memo:
+        context.release(start)
+    yield None, result
+
+
+def scan_rule(node, context, start):
+    """ Apply the definition. """
+    if context.budget is not None:
+        context.budget.step(node, context, start)
+
+    result = yield node.definition(), start
+    yield None, result
+
+
+def scan_switch_tag(node, context, start):
+    """ Look up the parser for the tag of the next item. """
+    text = context.text
+
+    if start < len(text):
+        this = node.cases.get(getattr(text[start], node.attr), node.default)
+    else:
+        context.hit_end = True
+        this = node.default
+
+    if this is None:
+        yield None, context.fail(start, node.expected)
+        return
+
+    result = yield this, start
+    yield None, result
+
+
+#: the generators applying each kind of combinator
+HANDLERS = {
+    LabelParser: scan_label,
+    MapParser: scan_map,
+    GuardParser: scan_guard,
+    BetweenParser: scan_between,
+    MemoParser: scan_memo,
+    IgnoreParser: scan_ignore,
+    IgnoreFollowingParser: scan_ignore_following,
+    SequenceParser: scan_sequence,
+    ChoiceParser: scan_choice,
+    ChoiceNoBacktrackParser: scan_choice,
+    CommitParser: scan_commit,
+    Rule: scan_rule,
+    SwitchTagParser: scan_switch_tag,
+}
+
+
+def evaluate(prsr, context, start):
+    """
+    Apply `prsr` at `start` with the internal protocol of `_scan`, keeping
+    the combinators being applied on an explicit stack. The stack grows
+    with the nesting of the input rather than with the layers of
+    combinators, and is not bound by the Python recursion limit.
+    """
+    handlers = HANDLERS
+    stack = []
+    node, pos = prsr, start
+
+    try:
+        while True:
+            handler = handlers.get(type(node))
+            if handler is not None:
+                frame = handler(node, context, pos)
+                stack.append(frame)
+                node, pos = next(frame)
+                continue
+
+            if node is None:
+                # the frame on top is done, its outcome is in `pos`
+                result = pos
+                stack.pop()
+            else:
+                result = node._scan(context, pos)
+
+            if not stack:
+                return result
+            node, pos = stack[-1].send(result)
+    except BaseException:
+        # unwind the frames in order, as recursive calls would
+        while stack:
+            stack.pop().close()
+        raise
+
+
+class IterativeParser(AbstractParser):
+    """ Applies `prsr` with :func:`evaluate`. """
+    def __init__(self, prsr):
+        self.prsr = prsr
+        self.expected = prsr.expected
+
+    def _scan(self, context, start):
+        return evaluate(self.prsr, context, start)
+
+    def first(self):
+        return self.prsr.first()
+
+    def literal_prefix(self):
+        return self.prsr.literal_prefix()
+
+
+def iterative(prsr):
+    """
+    An equivalent parser to `prsr` that does not use Python recursion to
+    apply combinators, so that deeply nested input does not run into the
+    recursion limit. Parsing functions, compiled parsers and other parser
+    classes are still applied through their own `_scan`.
+    """
+    return IterativeParser(prsr)
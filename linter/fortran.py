@@ -1,17 +1,34 @@
 """ A Fortran code analyzer and linter. """
+import re
+import sys
 from argparse import ArgumentParser
 from collections import defaultdict, namedtuple
+from functools import partial
 
-from . import alphanumeric, letter, digit, one_of, whitespace, none_of
+from . import letter, digits, one_of, whitespace, none_of
 from . import Failure, succeed, matches, spaces, wildcard
-from . import join, exact, liberal, satisfies, singleton, EOF, parser, concat
+from . import join, exact, liberal, satisfies, singleton, EOF, concat
+from . import Memo, span, digit_chars, alphanumeric_chars, interned
+from . import letter_chars, space_chars, is_digit, is_alphanumeric
+from . import ParseContext, ParseBudget, ParseBudgetExceeded, Profiler
+from . import Rule, Lexer, Token, one_of_tags, none_of_tags, switch_tag
+from . import operators, separated_by
+from .engine import iterative
+from .optimizer import optimize
 
 
+@interned
 def inexact(string):
     """ Ignore case. """
     return exact(string, ignore_case=True)
 
 
+def lower(string):
+    """ The lower case version of `string`, unicode or not. """
+    return string.lower()
+
+
+@interned
 def keyword(string):
     """ Match a case-insensitive keyword. """
     return liberal(inexact(string))
@@ -27,14 +44,10 @@ def sum_parsers(parsers):
     return result
 
 
-class Token(object):
-    """ Classification of tokens. """
-    def __init__(self, tag, value):
-        self.value = value
-        self.tag = tag
-
-    def __repr__(self):
-        return self.tag + "{" + self.value + "}"
+@interned
+def keywords(*words):
+    """ Match a sequence of keywords, returning them joined by spaces. """
+    return sum_parsers([keyword(w) for w in words]) >> succeed(" ".join(words))
 
 
 def tag_token(tag):
@@ -42,10 +55,19 @@ def tag_token(tag):
     Returns a function that wraps a value with
     the specified `tag`.
     """
-    def inner(value):
-        """ The function that applies the `tag`. """
-        return Token(tag, value)
-    return inner
+    return partial(Token, tag)
+
+
+def reference_node(parts):
+    """
+    The expression tree of a variable, or of a function reference or an
+    array element, given its name and arguments.
+    """
+    if len(parts) == 1:
+        return parts[0]
+
+    name, arguments = parts
+    return "()", name, arguments
 
 
 def name_tokens(list_of_tokens):
@@ -104,10 +126,18 @@ class Grammar(object):
                                     statements["misc nonexec"] +
                                     statements["top level"])
 
-    # order is important here
-    # because 'end' should come before 'end if' et cetera
-    statements["all"] = (statements["executable"] +
-                         statements["non-executable"])
+    # order is important here, as a line is classified by the first match:
+    # 'end if' should come before 'end', 'double precision' before 'do'
+    # et cetera, which reverse alphabetical order ensures
+    statements["all"] = sorted(statements["executable"] +
+                               statements["non-executable"],
+                               key=" ".join, reverse=True)
+
+    #: statement keyword parsers, kept alive so that lines share them
+    statement_keywords = [keywords(*words) for words in statements["all"]]
+    #: the keywords of the first statement type that matches,
+    #: only trying the ones that may start with the next character
+    statement_keyword = reduce(lambda x, y: x | y, statement_keywords)
 
     #: intrinsic functions
     intrinsics = ['abs', 'acos', 'aimag', 'aint', 'alog',
@@ -132,22 +162,29 @@ class Grammar(object):
     term = inexact
 
     #: valid Fortran identifier
-    name = letter + alphanumeric.many() // join
+    name = letter + span(alphanumeric_chars, "alphanumeric", 0, None,
+                         is_alphanumeric)
     #: statement label
-    label = digit.between(1, 5) // join
+    label = span(digit_chars, "digit", 1, 5, is_digit)
+    #: statement label in the label columns
+    label_number = liberal(label) // int
+    #: ``do`` statement that ends on a label
+    labelled_do = keyword("do") + liberal(label)
+    #: whole line comment
+    comment_line = EOF | one_of("*c") | keyword("!")
     #: integer literal
-    integer = (one_of("+-").optional() + +digit) // join
+    integer = one_of("+-").optional() // join + digits
     #: logical literal
     logical = term(".true.") | term(".false.")
     #: character literal segment
-    char_segment = ((term('"') + none_of('"').many() // join + term('"')) |
-                    (term("'") + none_of("'").many() // join + term("'")))
+    char_segment = ((term('"') + span('[^"]', 'none of "', 0) + term('"')) |
+                    (term("'") + span("[^']", "none of '", 0) + term("'")))
 
     #: character literal (string)
     character = (+char_segment) // join
     #: basic real number
-    basic_real = (one_of("+-").optional() + +digit +
-                  exact(".") // singleton + digit.many()) // join
+    basic_real = (one_of("+-").optional() // join + digits + exact(".") +
+                  span(digit_chars, "digit", 0, None, is_digit))
     #: single precision exponent part
     single_exponent = one_of("eE") + integer
     #: single precision real
@@ -160,7 +197,7 @@ class Grammar(object):
     #: real number literal
     real = double | single
     #: comment line
-    comment = exact("!") + none_of("\n").many() // join
+    comment = exact("!") + span("[^\n]", "none of \n", 0)
     #: arithmetic operators
     equals, plus, minus, times, slash = [exact(c) for c in "=+-*/"]
     #: comparison operators
@@ -179,6 +216,45 @@ class Grammar(object):
     #: string concatenation operator
     concatenation = exact("//")
 
+    #: expression, as a tree of ``(operator, operand)`` and ``(operator,
+    #: left, right)`` tuples with :class:`Token` leaves, where function
+    #: references and array elements are ``("()", name, arguments)``
+    expression = Rule("expression")
+    #: literal constant
+    constant = (real // tag_token("real") |
+                integer // tag_token("integer") |
+                logical // tag_token("logical") |
+                character // tag_token("character"))
+    #: variable, function reference or array element
+    reference = ((name // tag_token("name") // singleton +
+                  (liberal(lparen) >>
+                   separated_by(expression, liberal(comma), succeed([])) <<
+                   liberal(rparen)).optional()) //
+                 reference_node)
+    #: operand of an operator
+    primary = liberal(lparen >> expression << liberal(rparen) |
+                      constant | reference)
+    expression <<= operators(primary,
+                             prefix=[(liberal(plus), 50),
+                                     (liberal(minus), 50),
+                                     (liberal(not_), 20)],
+                             infix=[(liberal(times), 60),
+                                    (liberal(slash), 60),
+                                    (liberal(plus), 50),
+                                    (liberal(minus), 50),
+                                    (liberal(concatenation), 40),
+                                    (liberal(lt_), 30),
+                                    (liberal(le_), 30),
+                                    (liberal(eq_), 30),
+                                    (liberal(ne_), 30),
+                                    (liberal(gt_), 30),
+                                    (liberal(ge_), 30),
+                                    (liberal(and_), 15),
+                                    (liberal(or_), 10),
+                                    (liberal(eqv), 5),
+                                    (liberal(neqv), 5)],
+                             right=[(liberal(exponent), 70)])
+
     #: one single token
     single_token = (character // tag_token("character") |
                     comment // tag_token("comment") |
@@ -217,23 +293,67 @@ class Grammar(object):
                     spaces // tag_token("whitespace") |
                     wildcard // tag_token("unknown"))
 
-    #: list of tokens
-    tokenizer = (single_token).many()
+    #: list of tokens, split by the rules of `single_token` in one
+    #: regular expression, or by `single_token` itself in unicode input
+    tokenizer = Lexer([("character", r"""(?:"[^"]*"|'[^']*')+"""),
+                       ("comment", r"![^\n]*"),
+                       ("logical", r"\.true\.|\.false\."),
+                       ("lt", r"\.lt\."),
+                       ("le", r"\.le\."),
+                       ("eq", r"\.eq\."),
+                       ("ne", r"\.ne\."),
+                       ("gt", r"\.gt\."),
+                       ("ge", r"\.ge\."),
+                       ("not", r"\.not\."),
+                       ("and", r"\.and\."),
+                       ("or", r"\.or\."),
+                       ("eqv", r"\.eqv\."),
+                       ("neqv", r"\.neqv\."),
+                       ("real", r"(?:[+-]?[0-9]+\.[0-9]*|[+-]?[0-9]+)"
+                                r"[dD][+-]?[0-9]+|"
+                                r"[+-]?[0-9]+\.[0-9]*(?:[eE][+-]?[0-9]+)?|"
+                                r"[+-]?[0-9]+[eE][+-]?[0-9]+"),
+                       ("integer", r"[+-]?[0-9]+"),
+                       ("name", letter_chars + alphanumeric_chars + "*"),
+                       ("equals", r"="),
+                       ("plus", r"\+"),
+                       ("minus", r"-"),
+                       ("exponent", r"\*\*"),
+                       ("times", r"\*"),
+                       ("concat", r"//"),
+                       ("slash", r"/"),
+                       ("lparen", r"\("),
+                       ("rparen", r"\)"),
+                       ("dot", r"\."),
+                       ("comma", r","),
+                       ("dollar", r"\$"),
+                       ("apostrophe", r"'"),
+                       ("quote", r'"'),
+                       ("colon", r":"),
+                       ("langle", r"<"),
+                       ("rangle", r">"),
+                       ("whitespace", space_chars + "+"),
+                       ("unknown", r".")],
+                      re.IGNORECASE | re.DOTALL,
+                      # as matched by `inexact`
+                      dict.fromkeys(["logical", "lt", "le", "eq", "ne", "gt",
+                                     "ge", "not", "and", "or", "eqv",
+                                     "neqv"], lower),
+                      optimize(single_token.many()))
 
 
 def outer_block(statement):
-    """ Returns a function that marks a block with `statement`. """
-    def inner(children):
-        """
-        Wraps `children` in an :class:`OuterBlock`
-        marked as `statement`.
-        """
-        return OuterBlock(children, statement)
-    return inner
+    """
+    Returns a function that wraps children in an :class:`OuterBlock`
+    marked as `statement`.
+    """
+    return partial(OuterBlock, statement=statement)
 
 
 class OuterBlock(object):
     """ Represents a block. Its children are inner blocks. """
+    __slots__ = ('children', 'statement')
+
     def __init__(self, children, statement):
         self.children = children
         self.statement = statement
@@ -256,84 +376,123 @@ def inner_block(logical_lines):
     return InnerBlock(logical_lines)
 
 
-class InnerBlock(object):
-    """ Represents the statements inside a block. """
-    def __init__(self, logical_lines):
-        statements = Grammar.statements
-
-        @parser
-        def if_block(text, start):
-            """ Process an ``if`` block or statement. """
-            def new_style_if(list_of_lines):
-                """ An ``if`` statement accompanied by a ``then`` keyword. """
-                then = [token
-                        for token in name_tokens(list_of_lines.tokens_after)
-                        if token == 'then']
-                return len(then) > 0
-
-            if_statement = one_of_types([["if"]])
-            else_if_statement = one_of_types([["else", "if"]])
-            else_statement = one_of_types([["else"]])
-            end_if_statement = one_of_types([["end", "if"]])
-
-            begin = (if_statement.guard(new_style_if, "new style if") //
-                     singleton)
-            inner = (non_block | do_block | if_block |
-                     none_of_types([["end", "if"], ["else", "if"], ["else"]]))
-            else_or_else_if = else_if_statement | else_statement
-
-            def inner_block_or_empty(list_of_lines):
-                """
-                Wraps a list of lines in an :class:`InnerBlock`
-                if not already empty.
-                """
-                if list_of_lines != []:
-                    return [inner_block(list_of_lines)]
-                else:
-                    return []
+def inner_block_within(budget, grammar=None):
+    """
+    Returns a function that wraps logical lines into an :class:`InnerBlock`
+    parsed within the :class:`ParseBudget` `budget`, with the parser
+    `grammar` from :func:`block_parser` if given.
+    """
+    return partial(InnerBlock, budget=budget, grammar=grammar)
 
-            section = ((inner.many() // inner_block_or_empty) +
-                       else_or_else_if.optional()).guard(lambda l: l != [],
-                                                         "anything")
-            sections = section.many() // concat
 
-            end = (end_if_statement // singleton)
+def new_style_if(list_of_lines):
+    """ An ``if`` statement accompanied by a ``then`` keyword. """
+    then = [token
+            for token in name_tokens(list_of_lines.tokens_after)
+            if token == 'then']
+    return len(then) > 0
 
-            result = (((begin + sections + end) // outer_block("if_block"))
-                      .scan(text, start))
 
-            return result
+def new_style_do(list_of_lines):
+    """ A proper ``do`` block with ``end do``. """
+    return not matches(Grammar.labelled_do, list_of_lines.code)
+
+
+def block_parser(budget=None, memo=None):
+    """
+    A parser that organizes the statements inside a block into nested
+    ``if`` and ``do`` blocks, parsing the blocks inside within `budget`.
+    Nested blocks are memoized in the :class:`Memo` table `memo` if given.
+    The two kinds of blocks refer to each other as rules of one grammar,
+    which is built once and shared by all the blocks it finds. It is
+    applied without recursion, so that deeply nested blocks do not run
+    into the recursion limit, and optimized once when it is built.
+    """
+    statements = Grammar.statements
+
+    grammar = Rule("blocks")
+    if_block = Rule("if_block")
+    do_block = Rule("do_block")
+
+    nested_block = inner_block_within(budget, grammar)
+
+    non_block_statements = (statements["io"] + statements["assign"] +
+                            statements["specification"] +
+                            statements["misc nonexec"] +
+                            statements["control nonblock"])
+    non_block = one_of_types(non_block_statements)
+
+    def block_or(line):
+        """
+        A block, a statement that does not begin one, or else `line`.
+        Only the parser for the kind of the next statement is tried.
+        """
+        cases = dict.fromkeys([" ".join(name)
+                               for name in non_block_statements], non_block)
+        cases["do"] = do_block | line
+        cases["if"] = if_block | line
+        return switch_tag(cases, line, "statement")
+
+    # an ``if`` block or statement
+    if_statement = one_of_types([["if"]])
+    else_if_statement = one_of_types([["else", "if"]])
+    else_statement = one_of_types([["else"]])
+    end_if_statement = one_of_types([["end", "if"]])
+
+    begin = if_statement.guard(new_style_if, "new style if") // singleton
+    inner = block_or(none_of_types([["end", "if"], ["else", "if"],
+                                    ["else"]]))
+    else_or_else_if = else_if_statement | else_statement
+
+    # not empty, or the repetition of sections would never end
+    section = (((+inner // nested_block // singleton) +
+                else_or_else_if.optional()) |
+               else_or_else_if // singleton)
+    sections = section.many() // concat
+    end = end_if_statement // singleton
 
-        @parser
-        def do_block(text, start):
-            """ Process a ``do`` block. """
-            def new_style_do(list_of_lines):
-                """ A proper ``do`` block with ``end do``. """
-                return not matches(keyword("do") + liberal(Grammar.label),
-                                   list_of_lines.code.lower())
+    if_definition = (begin + sections + end) // outer_block("if_block")
 
-            do_statement = one_of_types([["do"]])
-            end_do_statement = one_of_types([["end", "do"]])
+    # a ``do`` block
+    do_statement = one_of_types([["do"]])
+    end_do_statement = one_of_types([["end", "do"]])
 
-            begin = (do_statement.guard(new_style_do, "new style do") //
-                     singleton)
+    begin = do_statement.guard(new_style_do, "new style do") // singleton
+    inner = (block_or(none_of_types([["end", "do"]])).many() //
+             nested_block // singleton)
+    end = end_do_statement // singleton
 
-            inner = ((non_block | do_block | if_block |
-                      none_of_types([["end", "do"]]))
-                     .many() // inner_block // singleton)
-            end = end_do_statement // singleton
+    do_definition = (begin + inner + end) // outer_block("do_block")
 
-            return (((begin + inner + end) // outer_block("do_block"))
-                    .scan(text, start))
+    if memo is not None:
+        if_definition = if_definition.memoize(memo)
+        do_definition = do_definition.memoize(memo)
 
-        non_block = one_of_types(statements["io"] + statements["assign"] +
-                                 statements["specification"] +
-                                 statements["misc nonexec"] +
-                                 statements["control nonblock"])
+    if_block <<= optimize(if_definition)
+    do_block <<= optimize(do_definition)
 
-        block_or_line = non_block | do_block | if_block | wildcard
+    grammar <<= iterative(optimize(block_or(wildcard).many()))
+    return grammar
+
+
+class InnerBlock(object):
+    """
+    Represents the statements inside a block. They are parsed within the
+    :class:`ParseBudget` `budget`, if given, by the parser `grammar` from
+    :func:`block_parser`, which is built if not given.
+    """
+    #: a :class:`Memo` table to enable packrat parsing of nested blocks,
+    #: or `None` to disable it
+    memo = None
 
-        self.children = block_or_line.many().parse(logical_lines)
+    __slots__ = ('children',)
+
+    def __init__(self, logical_lines, budget=None, grammar=None):
+        if grammar is None:
+            grammar = block_parser(budget, self.memo)
+
+        self.children = grammar.parse(
+            logical_lines, 0, ParseContext(logical_lines, budget))
 
     def accept(self, visitor):
         """
@@ -353,16 +512,25 @@ class RawLine(object):
     Represents a line in the source code.
     Classifies whether the line is a comment,
     an initial or a continuation line.
+    The `label`, `statement` and `cont` are `None` where not applicable.
     """
+    __slots__ = ('original', 'type', 'code', 'tokens', 'tokens_after',
+                 'label', 'statement', 'cont')
+
     def __init__(self, line):
         self.original = line
+        self.label = None
+        self.statement = None
+        self.cont = None
 
         continuation_column = Grammar.continuation_column
         margin_column = Grammar.margin_column
 
-        lowered = line.rstrip().lower()
+        # the only lower case copy of the line, as keywords ignore case
+        folded = line.lower()
+        lowered = folded.rstrip()
 
-        if matches(EOF | one_of("*c") | keyword("!"), lowered):
+        if matches(Grammar.comment_line, lowered):
             self.type = "comment"
             return
 
@@ -382,33 +550,18 @@ class RawLine(object):
         # extract the statement label if applicable
         statement_label = lowered[:continuation_column]
         if len(statement_label.strip()) > 0:
-            self.label = (liberal(Grammar.label) // int).parse(statement_label)
-
-        def check(words):
-            """ See if the words match any known (sequence of) keywords. """
-            msg = succeed(" ".join(words))
-            parser_sum = sum_parsers([keyword(w) for w in words])
-
-            try:
-                success = (parser_sum >> msg).scan(self.code)
-                tokenizer = Grammar.tokenizer
-
-                self.statement = success.value
-                self.tokens_after = tokenizer.parse(self.code,
-                                                    success.end)
-
-                # seems like a have a complete match
-                raise StopIteration()
-            except Failure:
-                pass
+            self.label = Grammar.label_number.parse(statement_label)
 
+        # see if the words match any known (sequence of) keywords
+        context = ParseContext(self.code, folded=folded[margin_column:])
         try:
-            for words in Grammar.statements["all"]:
-                check(words)
-        except StopIteration:
+            success = Grammar.statement_keyword.scan(self.code, 0, context)
+        except Failure:
+            self.statement = 'assignment'
             return
 
-        self.statement = 'assignment'
+        self.statement = success.value
+        self.tokens_after = Grammar.tokenizer.parse(self.code, success.end)
 
     def accept(self, visitor):
         """
@@ -425,6 +578,9 @@ class RawLine(object):
 
 class LogicalLine(object):
     """ Represents a logical line. Continuation lines are merged. """
+    __slots__ = ('children', 'statement', 'label',
+                 'code', 'tokens', 'tokens_after')
+
     def __init__(self, children):
         initial_line = [l for l in children if l.type == 'initial']
         assert len(initial_line) == 1
@@ -432,11 +588,7 @@ class LogicalLine(object):
 
         self.children = children
         self.statement = initial_line.statement
-
-        try:
-            self.label = initial_line.label
-        except AttributeError:
-            pass
+        self.label = initial_line.label
 
         code_lines = [l for l in children if l.type != 'comment']
 
@@ -459,23 +611,60 @@ class LogicalLine(object):
 
 def parse_into_logical_lines(lines):
     """ Groups a set of raw lines into logical lines. """
+    return list(iter_logical_lines(lines))
+
+
+def iter_logical_lines(lines):
+    """
+    Groups a set of raw lines into logical lines,
+    yielding each one as soon as it is complete.
+    """
+    return logical_line_parser().many().iterparse(lines)
+
+
+def logical_line_parser():
+    """
+    A parser that groups raw lines into one :class:`LogicalLine`.
+    Use it with :class:`FeedParser` to group lines as they are read.
+    """
     def of_type(type_name):
         """ A parser that recognizes only a specific kind of raw line. """
-        return satisfies(lambda l: l.type == type_name, type_name)
+        return one_of_tags((type_name,), type_name, "type")
 
     comment, continuation, initial = (of_type(t)
                                       for t in ['comment',
                                                 'continuation', 'initial'])
 
-    logical_line = (comment.many() + initial // singleton +
-                    (comment | continuation).many()) // LogicalLine
+    return (comment.many() + initial // singleton +
+            (comment | continuation).many()) // LogicalLine
 
-    return logical_line.many().parse(lines)
 
+def parse_source(logical_lines, budget=None):
+    """
+    Organizes a list of logical lines into blocks,
+    within the :class:`ParseBudget` `budget` if given.
+    """
+    return OuterBlock(list(iter_program_units(logical_lines, budget)),
+                      "source_file")
 
-def parse_source(logical_lines):
-    """ Organizes a list of logical lines into blocks. """
+
+def iter_program_units(logical_lines, budget=None):
+    """
+    Organizes a list of logical lines into blocks,
+    yielding each program unit as soon as it is parsed.
+    """
+    return (+program_unit_parser(budget)).iterparse(
+        logical_lines, 0, ParseContext(logical_lines, budget))
+
+
+def program_unit_parser(budget=None):
+    """
+    A parser that organizes logical lines into one program unit,
+    parsing the blocks inside within `budget`.
+    Use it with :class:`FeedParser` to parse units as lines arrive.
+    """
     statements = Grammar.statements
+    grammar = block_parser(budget, InnerBlock.memo)
 
     def top_level_block(kind, first_line_optional=False):
         """
@@ -488,7 +677,7 @@ def parse_source(logical_lines):
             first_line = one_of_types([kind]) // singleton
 
         mid_lines = (none_of_types(statements["top level"]).many() //
-                     inner_block // singleton)
+                     inner_block_within(budget, grammar) // singleton)
         last_line = one_of_types([["end"] + kind, ["end"]]) // singleton
 
         block_statement = "_".join(kind + ["block"])
@@ -505,9 +694,7 @@ def parse_source(logical_lines):
 
     main_program = top_level_block(["program"], True)
 
-    program_unit = subprogram | main_program
-
-    return (+program_unit // outer_block("source_file")).parse(logical_lines)
+    return subprogram | main_program
 
 
 def one_of_list(names):
@@ -525,16 +712,14 @@ def one_of_list(names):
 
 def one_of_types(names):
     """ Whether the statement belongs to any one of the given types. """
-    return satisfies(lambda l: l.statement in [" ".join(name)
-                                               for name in names],
-                     one_of_list(names))
+    return one_of_tags(tuple(" ".join(name) for name in names),
+                       one_of_list(names), "statement")
 
 
 def none_of_types(names):
     """ Whether the statement belongs to none of the given types. """
-    return satisfies(lambda l: l.statement not in [" ".join(name)
-                                                   for name in names],
-                     one_of_list(names))
+    return none_of_tags(tuple(" ".join(name) for name in names),
+                        one_of_list(names), "statement")
 
 
 def remove_blanks(raw_lines):
@@ -549,7 +734,7 @@ def new_comments(raw_lines):
     """ Converts old style comments to new style ones. """
     def of_type(type_name):
         """ Whether the line is of some particular type. """
-        return satisfies(lambda l: l.type == type_name, type_name)
+        return one_of_tags((type_name,), type_name, "type")
 
     def change_comment(line):
         """ Replace old comment characters with '!'. """
@@ -656,9 +841,9 @@ def print_details(doc):
                 return result
 
             elif line.type == "initial":
-                try:
+                if line.label is not None:
                     info = "{}[{}]: ".format(line.statement, line.label)
-                except AttributeError:
+                else:
                     info = "{}: ".format(line.statement)
 
                 return ["||| " * self.level + info + line.code.lstrip()]
@@ -685,6 +870,22 @@ def read_file(filename):
         return [RawLine(line) for line in input_file]
 
 
+def line_number(raw_lines, logical_lines, index):
+    """
+    The number of the line among `raw_lines` that the logical line at
+    `index` in `logical_lines` begins on, counting from one. Past the end,
+    the number of the last line.
+    """
+    if index >= len(logical_lines):
+        return len(raw_lines)
+
+    initial_line = [l for l in logical_lines[index].children
+                    if l.type == 'initial'][0]
+    for number, line in enumerate(raw_lines, 1):
+        if line is initial_line:
+            return number
+
+
 def parse_file(filename):
     """
     Read the contents of a file and convert it to our internal
@@ -709,9 +910,9 @@ def reconstruct(unit):
             if line.type == 'continuation':
                 result = " " * cont_col + line.cont
             else:
-                try:
+                if line.label is not None:
                     result = ("{:<" + str(marg_col) + "}").format(line.label)
-                except AttributeError:
+                else:
                     result = " " * marg_col
 
             for token in line.tokens:
@@ -831,11 +1032,8 @@ def analyze_labels(main_block):
         def logical_line(self, line):
             self.current_line += 1
 
-            try:
-                if line.statement != 'format':
-                    return [(self.current_line, line.label)]
-            except AttributeError:
-                pass
+            if line.label is not None and line.statement != 'format':
+                return [(self.current_line, line.label)]
 
             return []
 
@@ -974,6 +1172,19 @@ def _argument_parser_():
                             metavar="task",
                             help="in {}".format(task_list))
     arg_parser.add_argument("filename")
+    arg_parser.add_argument("--packrat", type=int, metavar="SIZE",
+                            help="memoize block parsing, keeping at most "
+                            "SIZE results")
+    arg_parser.add_argument("--max-steps", type=int, metavar="N",
+                            help="give up parsing after N steps")
+    arg_parser.add_argument("--max-backtrack", type=int, metavar="LINES",
+                            help="give up parsing when backtracking over "
+                            "more than LINES lines")
+    arg_parser.add_argument("--timeout", type=float, metavar="SECONDS",
+                            help="give up parsing after SECONDS seconds")
+    arg_parser.add_argument("--profile-grammar", action="store_true",
+                            help="report the parsers that took the most "
+                            "time on standard error")
     return arg_parser
 
 
@@ -1002,9 +1213,38 @@ def main():
     arg_parser = _argument_parser_()
     args = arg_parser.parse_args()
 
+    if args.packrat is not None:
+        InnerBlock.memo = Memo(args.packrat)
+
+    profiler = Profiler()
+    if args.profile_grammar:
+        profiler.enable()
+
     raw_lines = read_file(args.filename)
-    logical_lines = parse_into_logical_lines(read_file(args.filename))
-    parsed = parse_source(logical_lines)
+    source_lines = read_file(args.filename)
+    logical_lines = parse_into_logical_lines(source_lines)
+
+    if (args.max_steps is None and args.max_backtrack is None and
+            args.timeout is None):
+        budget = None
+    else:
+        budget = ParseBudget(args.max_steps, args.max_backtrack, args.timeout)
+
+    try:
+        parsed = parse_source(logical_lines, budget)
+    except ParseBudgetExceeded as exceeded:
+        def locate(index):
+            """ The line in the file of the logical line at `index`. """
+            return "line {}".format(line_number(source_lines, exceeded.text,
+                                                index))
+
+        arg_parser.exit(2, "{}: {}\n".format(args.filename,
+                                              exceeded.explain(locate)))
+    finally:
+        profiler.disable()
+
+    if args.profile_grammar:
+        sys.stderr.write(profiler.report() + "\n")
 
     if args.task == 'plain':
         print plain(parsed),
@@ -0,0 +1,247 @@
+"""
+Static analysis of parser graphs, to find grammar problems before they
+show up as parses that never end or take exponential time.
+"""
+from collections import namedtuple
+
+from .parsers import AbstractParser, BetweenParser, ChoiceParser
+from .parsers import ChoiceNoBacktrackParser, SequenceParser, IgnoreParser
+from .parsers import IgnoreFollowingParser, MapParser, LabelParser
+from .parsers import MemoParser, CommitParser, SucceedParser, Rule
+from .parsers import OperatorTable, dispatch_table, name_of, abbreviate
+from .tokens import ExactParser, SpanParser
+
+
+#: a problem of the `kind` ``"nullable repetition"``, ``"shadowed"``,
+#: ``"overlap"`` or ``"backtracking"``, found at `parser`
+Finding = namedtuple("Finding", ["kind", "parser", "message"])
+
+
+def sub_parsers(prsr):
+    """ The parsers `prsr` refers to. """
+    result = []
+
+    for value in vars(prsr).values():
+        if isinstance(value, OperatorTable):
+            value = value.parsers
+        elif isinstance(value, dict):
+            value = list(value.values())
+
+        if isinstance(value, AbstractParser):
+            result.append(value)
+        elif isinstance(value, list):
+            result.extend(this for this in value
+                          if isinstance(this, AbstractParser))
+
+    return result
+
+
+def all_parsers(prsr):
+    """ All the parsers reachable from `prsr`, each one once. """
+    seen = set()
+    result = []
+    pending = [prsr]
+
+    while pending:
+        this = pending.pop()
+        if id(this) not in seen:
+            seen.add(id(this))
+            result.append(this)
+            pending.extend(sub_parsers(this))
+
+    return result
+
+
+def describe_parser(prsr):
+    """ A short description of `prsr` for findings. """
+    return abbreviate(name_of(prsr), 40)
+
+
+def always_succeeds(prsr):
+    """ Whether `prsr` certainly succeeds, if without consuming input. """
+    if isinstance(prsr, SucceedParser):
+        return True
+    elif isinstance(prsr, BetweenParser):
+        return prsr.minimum == 0
+    elif isinstance(prsr, SpanParser):
+        return prsr.minimum == 0
+    elif isinstance(prsr, (MapParser, LabelParser, MemoParser,
+                           CommitParser)):
+        return always_succeeds(prsr.this)
+    elif isinstance(prsr, (IgnoreParser, IgnoreFollowingParser)):
+        return always_succeeds(prsr.this) and always_succeeds(prsr.that)
+    elif isinstance(prsr, SequenceParser):
+        return all(always_succeeds(this) for this in prsr.parsers)
+    elif isinstance(prsr, (ChoiceParser, ChoiceNoBacktrackParser)):
+        return any(always_succeeds(this) for this in prsr.parsers)
+    else:
+        return False
+
+
+def elements(prsr):
+    """
+    The parsers `prsr` applies one after another, looking through the
+    wrappers that do not change whether it succeeds.
+    """
+    if isinstance(prsr, SequenceParser):
+        return [this for part in prsr.parsers for this in elements(part)]
+    elif isinstance(prsr, (IgnoreParser, IgnoreFollowingParser)):
+        return elements(prsr.this) + elements(prsr.that)
+    elif isinstance(prsr, (MapParser, LabelParser, MemoParser)):
+        return elements(prsr.this)
+    elif isinstance(prsr, SucceedParser):
+        return []
+    else:
+        return [prsr]
+
+
+def same(this, that):
+    """ Whether the parsers `this` and `that` are known to be the same. """
+    return this is that or (isinstance(this, ExactParser) and
+                            isinstance(that, ExactParser) and
+                            this.ignore_case == that.ignore_case and
+                            this.string == that.string)
+
+
+def shadows(this, that):
+    """
+    Whether the alternative `this` succeeds on any input `that` succeeds
+    on, so that `that` is never reached when it comes after `this`.
+    """
+    these, those = elements(this), elements(that)
+
+    # what always succeeds at the end makes no difference
+    while these and always_succeeds(these[-1]):
+        these.pop()
+
+    if len(these) > len(those):
+        return False
+    if not these:
+        return True
+
+    last, other = these[-1], those[len(these) - 1]
+    return (all(same(x, y) for x, y in zip(these[:-1], those)) and
+            (same(last, other) or
+             (isinstance(last, ExactParser) and
+              isinstance(other, ExactParser) and
+              last.ignore_case == other.ignore_case and
+              other.string.startswith(last.string))))
+
+
+def fanout(choice):
+    """
+    The largest number of alternatives of `choice` that may be tried at
+    one position, according to their FIRST sets.
+    """
+    table, others, at_end = dispatch_table(choice.parsers)
+    return max([len(others), len(at_end)] +
+               [len(parsers) for parsers in table.values()])
+
+
+def check_repetition(prsr):
+    """ Repetitions of parsers that may succeed without consuming input. """
+    if (isinstance(prsr, BetweenParser) and
+            prsr.maximum == float('inf') and prsr.this.first()[1]):
+        yield Finding("nullable repetition", prsr,
+                      "{} may succeed without consuming input, so the "
+                      "repetition may never end"
+                      .format(describe_parser(prsr.this)))
+
+
+def check_choice(prsr):
+    """ Shadowed and overlapping alternatives of a choice. """
+    if not isinstance(prsr, (ChoiceParser, ChoiceNoBacktrackParser)):
+        return
+
+    alternatives = prsr.parsers
+    firsts = [this.first()[0] for this in alternatives]
+
+    for later in range(1, len(alternatives)):
+        for earlier in range(later):
+            if shadows(alternatives[earlier], alternatives[later]):
+                yield Finding("shadowed", prsr,
+                              "alternative {} ({}) is never reached, as "
+                              "alternative {} ({}) succeeds first"
+                              .format(later + 1,
+                                      describe_parser(alternatives[later]),
+                                      earlier + 1,
+                                      describe_parser(
+                                          alternatives[earlier])))
+                break
+
+            common = (firsts[earlier] & firsts[later]
+                      if None not in (firsts[earlier], firsts[later])
+                      else frozenset())
+            if common:
+                yield Finding("overlap", prsr,
+                              "alternatives {} and {} may both start with "
+                              "{}".format(earlier + 1, later + 1,
+                                          ", ".join(repr(char) for char
+                                                    in sorted(common))))
+
+
+def backtracking_depth(prsr):
+    """
+    An estimate of the worst case backtracking of `prsr`: the largest
+    number of choices that may try more than one alternative at a position,
+    nested within one another. Through recursion that passes such a choice
+    and no memoized parser the depth grows with the input, and is infinite.
+    """
+    depths = {}
+
+    def visit(this, stack):
+        """ The depth below `this`, with `stack` the parsers above it. """
+        key = id(this)
+        if key in depths:
+            return depths[key]
+
+        if any(other is this for other in stack):
+            cycle = stack[[id(other) for other in stack].index(key):]
+            if (any(isinstance(other, MemoParser) for other in cycle) or
+                    not any(backtracks(other) for other in cycle)):
+                return 0
+            return float('inf')
+
+        stack.append(this)
+        below = max([visit(other, stack) for other in sub_parsers(this)] +
+                    [0])
+        stack.pop()
+
+        depths[key] = below + (1 if backtracks(this) else 0)
+        return depths[key]
+
+    return visit(prsr, [])
+
+
+def backtracks(prsr):
+    """ Whether `prsr` is a choice that may try several alternatives. """
+    return (isinstance(prsr, (ChoiceParser, ChoiceNoBacktrackParser)) and
+            fanout(prsr) > 1)
+
+
+def lint(prsr, max_depth=None):
+    """
+    Look for problems in the grammar of `prsr` and return a list of
+    :class:`Finding` objects: repetitions of parsers that may not consume
+    input (``"nullable repetition"``), alternatives of a choice that an
+    earlier alternative leaves unreachable (``"shadowed"``), alternatives
+    that may start with the same character and so may need backtracking
+    (``"overlap"``), and, if `max_depth` is given, a `backtracking_depth`
+    beyond it (``"backtracking"``).
+    """
+    findings = []
+
+    for this in all_parsers(prsr):
+        if isinstance(this, Rule) and this.this is None:
+            continue
+        findings.extend(check_repetition(this))
+        findings.extend(check_choice(this))
+
+    if max_depth is not None:
+        depth = backtracking_depth(prsr)
+        if depth > max_depth:
+            findings.append(Finding("backtracking", prsr,
+                                    "up to {} nested choices may retry the "
+                                    "same input".format(depth)))
+
+    return findings
@@ -0,0 +1,253 @@
+"""
+A pass over parser graphs that produces equivalent parsers with fewer
+layers.
+"""
+from functools import partial, reduce
+
+from .parsers import LabelParser, MapParser, GuardParser, BetweenParser
+from .parsers import IgnoreParser, IgnoreFollowingParser, MemoParser
+from .parsers import SequenceParser, ChoiceParser, ChoiceNoBacktrackParser
+from .parsers import SucceedParser, CommitParser, Rule
+from .parsers import FailParser, AbstractParser, ParsingFunction
+from .tokens import ExactParser, OneOfParser, NoneOfParser, SatisfiesParser
+from .tokens import SpanParser, RegexParser
+
+
+#: parsers that fail, if they do, at the position they were applied at
+FAIL_AT_START = (LabelParser, ExactParser, OneOfParser, NoneOfParser,
+                 SatisfiesParser, SpanParser, RegexParser, FailParser)
+
+
+def composed(inner, outer, value):
+    """ Applies `inner`, then `outer`, to `value`. """
+    return outer(inner(value))
+
+
+def compose(inner, outer):
+    """
+    A function that applies `inner`, then `outer`. It can be pickled if
+    they can.
+    """
+    return partial(composed, inner, outer)
+
+
+def single_char(prsr):
+    """
+    The characters `prsr` recognizes if it consumes exactly one of them and
+    returns it, `None` otherwise.
+    """
+    if isinstance(prsr, OneOfParser) and isinstance(prsr.chars, str):
+        return prsr.chars
+    elif (isinstance(prsr, ExactParser) and not prsr.ignore_case and
+          len(prsr.string) == 1):
+        return prsr.string
+    else:
+        return None
+
+
+def fails_at_start(prsr):
+    """
+    Whether `prsr` is known to fail, if it does, at the position it was
+    applied at.
+    """
+    if isinstance(prsr, (MapParser, GuardParser, MemoParser)):
+        return fails_at_start(prsr.this)
+    elif isinstance(prsr, ChoiceParser):
+        return all(fails_at_start(this) for this in prsr.parsers)
+    else:
+        return isinstance(prsr, FAIL_AT_START)
+
+
+def may_commit(prsr, seen=None):
+    """
+    Whether `prsr` may leave the parse committed to a choice enclosing it,
+    that is, whether it has a cut not consumed by a choice within it.
+    """
+    if seen is None:
+        seen = set()
+    if id(prsr) in seen:
+        return False
+    seen.add(id(prsr))
+
+    if isinstance(prsr, CommitParser):
+        return True
+    elif isinstance(prsr, (ChoiceParser, ChoiceNoBacktrackParser)):
+        return False
+    elif isinstance(prsr, ParsingFunction):
+        return prsr.takes_context
+
+    children = list(getattr(prsr, "parsers", []))
+    for attr in ["this", "that", "prsr"]:
+        child = getattr(prsr, attr, None)
+        if isinstance(child, AbstractParser):
+            children.append(child)
+
+    return any(may_commit(child, seen) for child in children)
+
+
+class Optimizer(object):
+    """
+    Rewrites a parser graph bottom-up. Shared sub-parsers stay shared.
+    With `keep_positions`, failures are left where they were: labels are
+    only removed from parsers that fail where they start, and literals are
+    not merged.
+    """
+    def __init__(self, keep_positions=False):
+        self.done = {}
+        self.keep_positions = keep_positions
+
+        # the optimizer for the alternatives of choices without backtracking
+        self.positional = self if keep_positions else None
+
+    def visit(self, prsr):
+        """ The optimized version of `prsr`. """
+        key = id(prsr)
+
+        if key not in self.done:
+            method = getattr(self, type(prsr).__name__, None)
+            if method is None:
+                self.done[key] = prsr
+            else:
+                self.done[key] = method(prsr)
+
+        return self.done[key]
+
+    # pylint: disable=invalid-name
+    def LabelParser(self, prsr):
+        """
+        Labels only matter for failure descriptions, but they also move
+        failures back to where the labelled parser started. A labelled
+        choice with a cut in its alternatives is kept apart from any
+        enclosing choice, to which the cut would otherwise apply.
+        """
+        this = self.visit(prsr.this)
+
+        if self.keep_positions and not fails_at_start(this):
+            return LabelParser(this, prsr.expected)
+        elif (isinstance(this, ChoiceParser) and
+              any(may_commit(alt) for alt in this.parsers)):
+            return LabelParser(this, prsr.expected)
+        else:
+            return this
+
+    def MapParser(self, prsr):
+        """ Fuse chains of mapped functions. """
+        this = self.visit(prsr.this)
+
+        if isinstance(this, MapParser):
+            return MapParser(this.this, compose(this.function, prsr.function))
+        else:
+            return MapParser(this, prsr.function)
+
+    def GuardParser(self, prsr):
+        """ Optimize the guarded parser. """
+        return GuardParser(self.visit(prsr.this), prsr.predicate, prsr.desc)
+
+    def BetweenParser(self, prsr):
+        """ Optimize the repeated parser. """
+        return BetweenParser(self.visit(prsr.this),
+                             prsr.minimum, prsr.maximum)
+
+    def MemoParser(self, prsr):
+        """ Optimize the memoized parser. """
+        return MemoParser(self.visit(prsr.this), prsr.memo)
+
+    def CommitParser(self, prsr):
+        """ Optimize the committed parser. """
+        return CommitParser(self.visit(prsr.this))
+
+    def Rule(self, prsr):
+        """
+        Optimize the definition. The new rule is registered first, as the
+        definition may refer back to it.
+        """
+        rule = self.done[id(prsr)] = Rule(prsr.name)
+        return rule.define(self.visit(prsr.definition()))
+
+    def IgnoreParser(self, prsr):
+        """ Optimize both parsers. """
+        return IgnoreParser(self.visit(prsr.this), self.visit(prsr.that))
+
+    def IgnoreFollowingParser(self, prsr):
+        """ Optimize both parsers. """
+        return IgnoreFollowingParser(self.visit(prsr.this),
+                                     self.visit(prsr.that))
+
+    def SequenceParser(self, prsr):
+        """ Flatten nested sequences and merge adjacent literals. """
+        parsers = []
+
+        for this in self.flatten(prsr.parsers, SequenceParser):
+            last = parsers[-1] if parsers else None
+
+            if (isinstance(last, SucceedParser) and last.value == "" and
+                    isinstance(this, ExactParser)):
+                parsers[-1] = this
+            elif (not self.keep_positions and
+                  isinstance(last, ExactParser) and
+                  isinstance(this, ExactParser) and
+                  last.ignore_case == this.ignore_case):
+                parsers[-1] = ExactParser(last.string + this.string,
+                                          last.ignore_case)
+            else:
+                parsers.append(this)
+
+        return reduce(SequenceParser, parsers)
+
+    def ChoiceParser(self, prsr):
+        """
+        Flatten nested choices and collapse adjacent choices of single
+        characters into one character class.
+        """
+        parsers = []
+
+        for this in self.flatten(prsr.parsers, ChoiceParser):
+            chars = single_char(this)
+            last = single_char(parsers[-1]) if parsers else None
+
+            if chars is not None and last is not None:
+                parsers[-1] = OneOfParser(last + chars)
+            else:
+                parsers.append(this)
+
+        return reduce(ChoiceParser, parsers)
+
+    def ChoiceNoBacktrackParser(self, prsr):
+        """
+        Optimize the alternatives, keeping the positions of their failures,
+        by which the choice decides whether to try the next one.
+        """
+        if self.positional is None:
+            self.positional = Optimizer(keep_positions=True)
+
+        return reduce(ChoiceNoBacktrackParser,
+                      [self.positional.visit(this) for this in prsr.parsers])
+
+    def flatten(self, parsers, kind):
+        """
+        Optimize `parsers`, splicing in the members of those that turn out
+        to be of `kind`.
+        """
+        result = []
+
+        for this in parsers:
+            this = self.visit(this)
+            if isinstance(this, kind):
+                result.extend(this.parsers)
+            else:
+                result.append(this)
+
+        return result
+
+
+def optimize(prsr):
+    """
+    An equivalent parser to `prsr` with fewer layers. Map chains are
+    fused, adjacent literals merged, adjacent single characters in a choice
+    collapsed into one character class, and labels removed, except around
+    choices with cuts in their alternatives. The results are
+    the same, but failures are described in terms of the remaining parsers.
+    Within the alternatives of choices without backtracking, failures also
+    stay where they were, so the same alternatives are tried.
+    """
+    return Optimizer().visit(prsr)
@@ -2,33 +2,169 @@
 Some useful parser combinators.
 """
 
+import copy_reg
+import inspect
+import mmap
+import re
+import sys
+import time
 import types
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from functools import partial, wraps
 from itertools import chain
+from threading import Lock, local
+from timeit import default_timer
+from weakref import WeakValueDictionary
 
 
-def location(text, index):
+#: input types that hold bytes and support line and column numbers
+BYTE_TYPES = (str, bytearray, buffer, memoryview, mmap.mmap)
+
+
+def text_view(text):
+    """
+    A view of the input `text` that parsers can index, slice and match
+    regular expressions on, yielding strings. Byte arrays are wrapped in a
+    :func:`buffer` without copying them, memory-mapped files and buffers
+    already qualify. Memory views lack the interface regular expressions
+    need on Python 2, so their bytes are copied.
+    """
+    if isinstance(text, bytearray):
+        return buffer(text)
+    elif isinstance(text, memoryview):
+        return text.tobytes()
+    else:
+        return text
+
+
+class LineIndex(object):
+    """
+    Positions of the line breaks in `text`, found when first needed. The
+    line and column numbers of an index are found by binary search.
+    """
+    def __init__(self, text):
+        self.text = text
+        self.breaks = None
+
+    def location(self, index):
+        """ Line and column numbers of `index`, counting from one. """
+        if self.breaks is None:
+            self.breaks = [match.start()
+                           for match in re.finditer("\n",
+                                                    text_view(self.text))]
+
+        line = bisect_left(self.breaks, index)
+        start = self.breaks[line - 1] if line > 0 else -1
+        return line + 1, index - start
+
+
+def location(text, index, lines=None):
     """
     Location of `index` in the `text`. Report row and column numbers when
-    appropriate.
+    appropriate, using the :class:`LineIndex` `lines` of `text` if given.
 
     """
-    if isinstance(text, str):
-        line, start = text.count('\n', 0, index), text.rfind('\n', 0, index)
-        column = index - (start + 1)
-        return "{}:{}".format(line + 1, column + 1)
+    if isinstance(text, BYTE_TYPES):
+        if lines is None:
+            lines = LineIndex(text)
+        return "{}:{}".format(*lines.location(index))
     else:
         return str(index + 1)
 
 
+class Expected(object):
+    """
+    Description of what a parser expects: the descriptions `items` joined
+    by `conjunction`. It is only formatted when printed.
+    """
+    def __init__(self, items, conjunction):
+        self.items = items
+        self.conjunction = conjunction
+        self.formatted = None
+
+    def __str__(self):
+        if self.formatted is None:
+            self.formatted = self.conjunction.join(str(item)
+                                                   for item in self.items)
+        return self.formatted
+
+    def __repr__(self):
+        return "Expected({!r})".format(str(self))
+
+
+def describe(expected):
+    """ Format `expected` if it is an :class:`Expected` description. """
+    if isinstance(expected, Expected):
+        return str(expected)
+    else:
+        return expected
+
+
 class Failure(Exception):
-    """ Represents parsing failure. Can be raised as an :class:`Exception`. """
-    def __init__(self, text, start, expected):
+    """
+    Represents parsing failure. Can be raised as an :class:`Exception`.
+    Also records the `furthest` position where any parser failed, and the
+    `expectations` there. The messages are only formatted when needed,
+    with the line breaks in `text` looked up in the :class:`LineIndex`
+    `lines`, which is built then if not given.
+    """
+    __slots__ = ('text', 'start', 'expectation',
+                 'furthest', 'furthest_expectations', 'lines')
+
+    def __init__(self, text, start, expected,
+                 furthest=None, expectations=None, lines=None):
+        super(Failure, self).__init__()
         self.text = text
         self.start = start
-        self.expected = expected
+        self.expectation = expected
+        self.lines = lines
+
+        if furthest is None or furthest < start:
+            furthest, expectations = start, [expected]
+
+        self.furthest = furthest
+        self.furthest_expectations = expectations
+
+    @property
+    def expected(self):
+        """ Description of what was expected at `start`. """
+        return describe(self.expectation)
+
+    @property
+    def expectations(self):
+        """ Distinct descriptions of what was expected at `furthest`. """
+        result = []
+        for expected in self.furthest_expectations:
+            expected = describe(expected)
+            if expected not in result:
+                result.append(expected)
+        return result
+
+    def locate(self, index):
+        """ Location of `index` in `text`. """
+        if self.lines is None:
+            self.lines = LineIndex(self.text)
+        return location(self.text, index, self.lines)
+
+    @property
+    def msg(self):
+        """ The error message. """
+        return "expected {} at {}".format(self.expected,
+                                          self.locate(self.start))
+
+    def explain(self):
+        """
+        A detailed error message, also reporting what was expected at the
+        furthest position reached.
+        """
+        if self.furthest == self.start:
+            return self.msg
 
-        self.msg = "expected {} at {}".format(expected, location(text, start))
-        super(Failure, self).__init__(self.msg)
+        return ("{}, furthest at {} expected {}"
+                .format(self.msg, self.locate(self.furthest),
+                        " or ".join(str(expected)
+                                    for expected in self.expectations)))
 
     def __str__(self):
         return self.msg
@@ -40,6 +176,8 @@ class Failure(Exception):
 
 class Success(object):
     """ Represents parsing success. Stores the parsed value. """
+    __slots__ = ('text', 'start', 'end', 'value')
+
     def __init__(self, text, start, end, value):
         self.text = text
         self.start = start
@@ -47,44 +185,326 @@ class Success(object):
         self.value = value
 
     def __str__(self):
+        lines = LineIndex(self.text)
         return ("value {} from {} to {}"
-                .format(self.value, location(self.text, self.start),
-                        location(self.text, self.end)))
+                .format(self.value, location(self.text, self.start, lines),
+                        location(self.text, self.end, lines)))
 
     def __repr__(self):
+        lines = LineIndex(self.text)
         return ("Success({}, {}, {}, {})"
-                .format(self.text, location(self.text, self.start),
-                        location(self.text, self.end),
+                .format(self.text, location(self.text, self.start, lines),
+                        location(self.text, self.end, lines),
                         self.value))
 
 
+class ParseContext(object):
+    """
+    The state of one application of a parser to the input `source`, which
+    is accessed as `text` through a :func:`text_view`, so that any byte
+    buffer is parsed in place. Failing parsers record where and why they
+    failed in `failure`. The context also keeps track of the `furthest`
+    failure position and the `expectations` there.
+    Parsers set `hit_end` when they looked at the end of `text`, that is,
+    when more input could have changed their outcome. A failure past a cut
+    sets `committed` until the enclosing choice gives up on account of it.
+
+    All the state of a parse lives here, including the `memo` table of
+    parsers memoized without a table of their own and the optional
+    :class:`ParseBudget`, so parsers themselves can be shared by any number
+    of threads.
+
+    The input may come with `folded`, a lower case copy of `text` of the
+    same length, which parsers that ignore case match against instead of
+    lowering every slice of `text` they look at.
+
+    The errors raised from one context share the :class:`LineIndex` of its
+    input, see :meth:`line_index`.
+    """
+    def __init__(self, text, budget=None, folded=None):
+        self.source = text
+        self.text = text_view(text)
+        self.folded = folded
+        self.lines = None
+        self.failure = None
+        self.hit_end = False
+        self.committed = False
+        self.memo = None
+        self.budget = budget
+
+        self.furthest = -1
+        self.expectations = []
+
+    def fail(self, start, expected):
+        """ Record a failure at `start` and return `None`. """
+        self.failure = (start, expected)
+
+        if start >= self.furthest:
+            if start > self.furthest:
+                self.furthest = start
+                self.expectations = []
+            self.expectations.append(expected)
+
+    def release(self, position):
+        """
+        Forget the results in the `memo` of parsers applied before
+        `position`, a cut past which the parse has committed.
+        """
+        table = self.memo
+        if table:
+            for key in [key for key in table if key[1] < position]:
+                del table[key]
+
+    def line_index(self):
+        """ The :class:`LineIndex` of the input, built on first use. """
+        if self.lines is None:
+            self.lines = LineIndex(self.source)
+        return self.lines
+
+    def error(self):
+        """ The :class:`Failure` for the last recorded failure. """
+        failed, expected = self.failure
+        return Failure(self.source, failed, expected,
+                       self.furthest, self.expectations, self.line_index())
+
+
+def name_of(prsr):
+    """ A short description of `prsr` for reports. """
+    if isinstance(prsr, ParsingFunction):
+        return prsr.this.__name__
+    elif isinstance(prsr, Rule):
+        return prsr.name
+    elif prsr.expected is not None:
+        return describe(prsr.expected)
+    else:
+        return type(prsr).__name__
+
+
+def abbreviate(desc, width=30):
+    """ Shorten the description `desc` to at most `width` characters. """
+    if len(desc) > width:
+        return desc[:width - 3] + "..."
+    return desc
+
+
+class ParseBudgetExceeded(Exception):
+    """
+    Raised when a parse runs out of its :class:`ParseBudget`. Records which
+    `limit` was hit, where (`start` in `text`), the `steps` taken and
+    seconds `elapsed` so far, the `furthest` position reached, and the
+    `busiest` parsers with the number of steps spent in each.
+    """
+    def __init__(self, limit, context, start, budget):
+        super(ParseBudgetExceeded, self).__init__()
+        self.limit = limit
+        self.text = context.source
+        self.lines = context.line_index()
+        self.start = start
+        self.furthest = context.furthest
+        self.steps = budget.steps
+        self.elapsed = time.time() - budget.started
+
+        spent = Counter()
+        for prsr, steps in budget.spent.items():
+            spent[name_of(prsr)] += steps
+        self.busiest = spent.most_common(5)
+
+    def explain(self, locate=None):
+        """
+        The error message, with positions in `text` described by the
+        function `locate`, :func:`location` by default.
+        """
+        if locate is None:
+            locate = partial(location, self.text, lines=self.lines)
+
+        return ("parse budget exceeded ({}) at {} after {} steps and {:.1f}s,"
+                " furthest at {}, busiest: {}"
+                .format(self.limit, locate(self.start),
+                        self.steps, self.elapsed,
+                        locate(max(self.furthest, self.start)),
+                        ", ".join("{} ({})".format(abbreviate(name), steps)
+                                  for name, steps in self.busiest)))
+
+    def __str__(self):
+        return self.explain()
+
+
+class ParseBudget(object):
+    """
+    Limits the work spent on parsing: at most `max_steps` applications of
+    choices, repetitions and parsing functions, no choice backtracking over
+    more than `max_backtrack` positions, and at most `timeout` seconds from
+    the creation of the budget. Exceeding a limit raises
+    :class:`ParseBudgetExceeded`. A budget is passed to a parse with its
+    :class:`ParseContext`, and may be shared by the nested parses of one
+    input.
+    """
+    #: number of steps between looking at the clock
+    clock_interval = 1000
+
+    def __init__(self, max_steps=None, max_backtrack=None, timeout=None):
+        self.max_steps = max_steps
+        self.max_backtrack = max_backtrack
+
+        self.started = time.time()
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = self.started + timeout
+
+        self.steps = 0
+        self.spent = Counter()
+
+    def step(self, prsr, context, start):
+        """ Count an application of `prsr` at `start`. """
+        self.steps += 1
+        self.spent[prsr] += 1
+
+        if self.max_steps is not None and self.steps > self.max_steps:
+            raise ParseBudgetExceeded("steps", context, start, self)
+
+        if (self.deadline is not None and
+                self.steps % self.clock_interval == 0 and
+                time.time() > self.deadline):
+            raise ParseBudgetExceeded("deadline", context, start, self)
+
+    def backtrack(self, context, start):
+        """ Check a choice giving up on an alternative started at `start`. """
+        if (self.max_backtrack is not None and
+                context.failure[0] - start > self.max_backtrack):
+            raise ParseBudgetExceeded("backtrack", context, start, self)
+
+
 class AbstractParser(object):
     """
     A base class for parser objects.
+
+    Internally, parsers are applied through `_scan`, which returns an
+    ``(end, value)`` tuple on success and `None` on failure. This way no
+    exception is raised and no :class:`Success` object is built while
+    alternatives are being tried out.
     """
 
-    def scan(self, text, start=0):
+    def scan(self, text, start=0, context=None):
         """
-        A virtual method that subclasses should override.
         Returns a :class:`Success` object or raises :class:`Failure`.
+        A parser applied as part of an ongoing parse of `text` is passed its
+        :class:`ParseContext` to share its state.
         """
-        raise NotImplementedError("scan not implemented in AbstractParser")
+        if context is None:
+            context = ParseContext(text)
 
-    def parse(self, text, start=0):
+        result = self._scan(context, start)
+
+        if result is None:
+            raise context.error()
+
+        end, value = result
+        return Success(text, start, end, value)
+
+    def _scan(self, context, start):
+        """
+        A virtual method that subclasses should override.
+        Returns an ``(end, value)`` tuple, or records the failure in
+        `context` and returns `None`.
+        """
+        if type(self).scan == AbstractParser.scan:
+            raise NotImplementedError("scan not implemented in AbstractParser")
+
+        # a subclass that only implements the public protocol,
+        # which might have looked anywhere in the text
+        context.hit_end = True
+        try:
+            success = self.scan(context.text, start)
+        except Failure as failure:
+            return context.fail(failure.start, failure.expectation)
+
+        return success.end, success.value
+
+    def first(self):
+        """
+        The FIRST set of the parser: the set of characters that any input
+        it consumes can start with (`None` if unknown), and whether it can
+        succeed without consuming input.
+        """
+        return None, True
+
+    def literal_prefix(self):
+        """
+        A string that any input the parser consumes starts with, the empty
+        string if none is known.
+        """
+        return ""
+
+    def parse(self, text, start=0, context=None):
         """ Apply the parser and return success value assuming it succeeds. """
-        return self.scan(text, start).value
+        return self.scan(text, start, context).value
+
+    def iterparse(self, text, start=0, context=None):
+        """
+        Apply the parser and yield the items of its list value. Repetitions
+        yield each item as soon as it is recognized, and raise
+        :class:`Failure` only once too few items were found.
+        """
+        for value in self.parse(text, start, context):
+            yield value
+
+    def scan_all(self, text, start=0, context=None):
+        """
+        Yield a :class:`Success` object for every position from `start` on
+        where the parser matches, in order, however the matches overlap.
+        Only the positions where its FIRST set or its literal prefix say it
+        may match are tried, all with the same :class:`ParseContext`.
+        """
+        return self.matches_from(text, start, context, True)
+
+    def finditer(self, text, start=0, context=None):
+        """
+        Yield a :class:`Success` object for every non-overlapping match from
+        `start` on, like :func:`re.finditer`: the search for the next match
+        resumes where the last one ended, or one past it if it was empty.
+        """
+        return self.matches_from(text, start, context, False)
+
+    def search(self, text, start=0, context=None):
+        """
+        The :class:`Success` object of the first match from `start` on, or
+        `None` if there is none, like :func:`re.search`.
+        """
+        for success in self.scan_all(text, start, context):
+            return success
+        return None
+
+    def matches_from(self, text, start, context, overlapping):
+        """ The matches for `scan_all` and `finditer`. """
+        if context is None:
+            context = ParseContext(text)
+
+        find = candidate_finder(self, context.text)
+        pos = find(start)
+
+        while pos is not None:
+            context.failure = None
+            context.committed = False
+
+            result = self._scan(context, pos)
+            if result is None:
+                pos = find(pos + 1)
+                continue
+
+            end, value = result
+            yield Success(text, pos, end, value)
+
+            if overlapping or end == pos:
+                pos = find(pos + 1)
+            else:
+                pos = find(end)
 
     def ignore(self, other):
         """
         Apply `self`, ignore result, and apply `other` (shortcut: ``>>``).
         """
-        @parser
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            success_self = self.scan(text, start)
-            success_other = other.scan(text, success_self.end)
-            return Success(text, start, success_other.end, success_other.value)
-        return inner
+        return IgnoreParser(self, other)
 
     def __rshift__(self, other):
         """ ``>>`` is shortcut for `ignore`. """
@@ -95,13 +515,7 @@ class AbstractParser(object):
         Apply `self`, apply `other`, return result of `self`
         (shortcut: ``<<``).
         """
-        @parser
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            success_self = self.scan(text, start)
-            success_other = other.scan(text, success_self.end)
-            return Success(text, start, success_other.end, success_self.value)
-        return inner
+        return IgnoreFollowingParser(self, other)
 
     def __lshift__(self, other):
         """ ``<<`` is shortcut for `ignore_following`. """
@@ -137,13 +551,23 @@ class AbstractParser(object):
         """ ``+`` is shortcut for `seq`. """
         return self.seq(other)
 
+    def cut(self, other):
+        """
+        Like `seq`, but once `self` succeeded, a failure of `other` is final:
+        the enclosing choice tries no further alternatives, and enclosing
+        repetitions fail rather than stop (shortcut: ``&``). Once `other`
+        succeeded too, the results memoized for the parse before it are
+        released.
+        """
+        return SequenceParser(self, CommitParser(other))
+
+    def __and__(self, other):
+        """ ``&`` is shortcut for `cut`. """
+        return self.cut(other)
+
     def label(self, expected):
         """ Labels a failure with `expected` (shortcut: ``%``). """
-        @parser(expected)
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            return self.scan(text, start)
-        return inner
+        return LabelParser(self, expected)
 
     def __mod__(self, expected):
         """ ``%`` is shortcut for `label`. """
@@ -154,13 +578,7 @@ class AbstractParser(object):
         A parser that applies `function` on the result of `self`
         (shortcut: ``//``).
         """
-        @parser
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            success = self.scan(text, start)
-            return Success(text, success.start, success.end,
-                           function(success.value))
-        return inner
+        return MapParser(self, function)
 
     def __floordiv__(self, function):
         """ ``//`` is shortcut for `map`. """
@@ -168,43 +586,14 @@ class AbstractParser(object):
 
     def guard(self, predicate, desc):
         """ Check if the parse result satisfies a `predicate`. """
-        @parser
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            success = self.scan(text, start)
-            if predicate(success.value):
-                return success
-            else:
-                raise Failure(text, start, desc)
-        return inner
+        return GuardParser(self, predicate, desc)
 
     def between(self, minimum, maximum):
         """
         A parser that applies `self` between `minimum`
         and `maximum` times and returns a list of values.
         """
-        @parser
-        def inner(text, start):
-            """ The function doing the actual parsing. """
-            result = []
-            count = 0
-
-            current = start
-
-            while count < maximum:
-                try:
-                    success = self.scan(text, current)
-                    result += [success.value]
-                    current = success.end
-                    count = count + 1
-
-                except Failure as failure:
-                    if count >= minimum:
-                        break
-                    raise failure
-
-            return Success(text, start, current, result)
-        return inner
+        return BetweenParser(self, minimum, maximum)
 
     def times(self, exact):
         """
@@ -241,36 +630,92 @@ class AbstractParser(object):
         """ ``+`` is shortcut for `at_least_once`. """
         return self.at_least_once()
 
+    def memoize(self, memo=None):
+        """
+        A parser that stores its results in the :class:`Memo` table `memo`,
+        so that it is applied at most once at any position of an input.
+        Without a table, results are kept for the duration of each parse.
+        """
+        return MemoParser(self, memo)
+
+
+class ParsingFunction(AbstractParser):
+    """
+    A class to hold the parsing function.
+    """
+    def __init__(self, this, expected):
+        """
+        The function `this` should return a :class:`Success` object
+        if successful, or raise a :class:`Failure` exception if not.
+        It is passed the text and the starting position, and, if it takes
+        a third argument, the :class:`ParseContext` to pass on to `scan`.
+        """
+        self.this = this
+        self.expected = expected
+        self.takes_context = takes_context(this)
+
+    def _scan(self, context, start):
+        """
+        Run the parsing function.
+        """
+        if context.budget is not None:
+            context.budget.step(self, context, start)
+
+        try:
+            if self.takes_context:
+                success = self.this(context.text, start, context)
+            else:
+                # it might have looked anywhere in the text
+                context.hit_end = True
+                success = self.this(context.text, start)
+        except Failure as failure:
+            if self.expected is None:
+                return context.fail(failure.start, failure.expectation)
+            else:
+                return context.fail(start, self.expected)
+
+        return success.end, success.value
+
+    def __reduce__(self):
+        # a function decorated with `parser` is only found under its name
+        # as this parser, so that is how it is pickled
+        module = sys.modules.get(self.this.__module__)
+        if getattr(module, self.this.__name__, None) is self:
+            return load_global, (self.this.__module__, self.this.__name__)
+
+        return ParsingFunction, (self.this, self.expected)
+
+
+def load_global(module, name):
+    """ The object named `name` in the `module`, imported if necessary. """
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+def reduce_method_descriptor(method):
+    """
+    Pickle methods of built-in types such as ``str.lower``, common
+    predicates and functions of parsers, by their class and name.
+    """
+    return getattr, (method.__objclass__, method.__name__)
+
+
+copy_reg.pickle(type(str.lower), reduce_method_descriptor)
+
+
+def takes_context(function):
+    """ Whether the parsing `function` takes the context as well. """
+    try:
+        return len(inspect.getargspec(function).args) > 2
+    except TypeError:
+        return False
+
 
 def parser(param):
     """
     Construct a parser from either a given function object
     or a string to match.
     """
-    class ParsingFunction(AbstractParser):
-        """
-        A class to hold the parsing function.
-        """
-        def __init__(self, this, expected):
-            """
-            The function `this` should return a :class:`Success` object
-            if successful, or raise a :class:`Failure` exception if not.
-            """
-            self.this = this
-            self.expected = expected
-
-        def scan(self, text, start=0):
-            """
-            Run the parsing function.
-            """
-            try:
-                return self.this(text, start)
-            except Failure as failure:
-                if self.expected is None:
-                    raise failure
-                else:
-                    raise Failure(text, start, self.expected)
-
     if isinstance(param, str) or isinstance(param, unicode):
         expected = param
 
@@ -291,6 +736,478 @@ def parser(param):
                          .format(param))
 
 
+#: the FIRST sets of the rules being computed, in each thread
+_pending_firsts = local()
+
+#: the rules whose literal prefixes are being computed, in each thread
+_pending_prefixes = local()
+
+
+class Rule(AbstractParser):
+    """
+    A parser named `name` that is declared before it is defined, so that
+    rules can refer to each other, and to themselves, in one static parser
+    graph. Define it with `define` (shortcut: ``<<=``)::
+
+        expr = Rule("expr")
+        term = (digits | exact("(") >> expr << exact(")")) // singleton
+        expr <<= term + (~(exact("+") >> term) // concat)
+
+    Failures are passed through as those of parsing functions are.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.this = None
+        self.expected = None
+
+    def define(self, this):
+        """ Make `this` the definition of the rule. Returns the rule. """
+        if self.this is not None:
+            raise ValueError("rule {} is already defined".format(self.name))
+
+        self.this = this
+        return self
+
+    def __ilshift__(self, this):
+        """ ``<<=`` is shortcut for `define`. """
+        return self.define(this)
+
+    def definition(self):
+        """ The parser the rule stands for. """
+        if self.this is None:
+            raise ValueError("rule {} is not defined".format(self.name))
+
+        return self.this
+
+    def _scan(self, context, start):
+        if context.budget is not None:
+            context.budget.step(self, context, start)
+
+        this = self.this
+        if this is None:
+            this = self.definition()
+
+        return this._scan(context, start)
+
+    def first(self):
+        """
+        The least fixed point of the FIRST set equations through this rule:
+        a recursive reference sees the approximation computed so far.
+        """
+        pending = getattr(_pending_firsts, "rules", None)
+        if pending is None:
+            pending = _pending_firsts.rules = {}
+
+        if self in pending:
+            return pending[self]
+
+        definition = self.definition()
+        pending[self] = frozenset(), False
+        try:
+            while True:
+                result = definition.first()
+                if result == pending[self]:
+                    return result
+                pending[self] = result
+        finally:
+            del pending[self]
+
+    def literal_prefix(self):
+        # a rule that begins with itself has none
+        pending = getattr(_pending_prefixes, "rules", None)
+        if pending is None:
+            pending = _pending_prefixes.rules = set()
+
+        if self in pending:
+            return ""
+
+        pending.add(self)
+        try:
+            return self.definition().literal_prefix()
+        finally:
+            pending.discard(self)
+
+    def __repr__(self):
+        return "Rule({!r})".format(self.name)
+
+
+def candidate_finder(prsr, text):
+    """
+    A function that returns the first position from a given one where
+    `prsr` may match in `text`, or `None`. Byte strings are searched with
+    a regular expression for its literal prefix or its FIRST set, unicode
+    strings only for its literal prefix; other sequences, such as lists of
+    tokens, item by item.
+    """
+    chars, nullable = prsr.first()
+    size = len(text)
+    last = size if nullable else size - 1
+    textual = isinstance(text, BYTE_TYPES + (unicode,))
+
+    prefix = prsr.literal_prefix()
+    if prefix and textual:
+        exp = re.compile(re.escape(prefix))
+    elif (nullable or chars is None or isinstance(text, unicode) or
+          not all(isinstance(char, basestring) for char in chars)):
+        # FIRST sets only tell which byte characters a parser starts with
+        exp = None
+    elif not chars:
+        return lambda pos: None
+    elif textual:
+        exp = re.compile("[{}]".format("".join(re.escape(char)
+                                               for char in sorted(chars))))
+    else:
+        def find(pos):
+            """ Look at each item in turn. """
+            while pos <= last:
+                if text[pos] in chars or isinstance(text[pos], unicode):
+                    return pos
+                pos += 1
+            return None
+        return find
+
+    if exp is None:
+        return lambda pos: pos if pos <= last else None
+
+    def search(pos):
+        """ Search ahead with the regular expression. """
+        found = exp.search(text, pos) if pos <= last else None
+        return found.start() if found is not None else None
+    return search
+
+
+def interned(factory):
+    """
+    Make the parser `factory` return the same parser when called with the
+    same arguments, for as long as that parser is alive elsewhere. Repeated
+    construction costs a dictionary lookup, and identical parsers share
+    whatever is built or memoized for them.
+    """
+    cache = WeakValueDictionary()
+
+    @wraps(factory)
+    def inner(*args, **kwargs):
+        """ Look up the parser before constructing it. """
+        key = (args, tuple(sorted(kwargs.items())))
+
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments
+            return factory(*args, **kwargs)
+
+        result = cache[key] = factory(*args, **kwargs)
+        return result
+
+    return inner
+
+
+class IgnoreParser(AbstractParser):
+    """ Applies `this`, then `that`, and returns the result of `that`. """
+    def __init__(self, this, that):
+        self.this = this
+        self.that = that
+        self.expected = None
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            return None
+
+        return self.that._scan(context, result[0])
+
+    def first(self):
+        return sequence_first([self.this, self.that])
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class IgnoreFollowingParser(AbstractParser):
+    """ Applies `this`, then `that`, and returns the result of `this`. """
+    def __init__(self, this, that):
+        self.this = this
+        self.that = that
+        self.expected = None
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            return None
+
+        end, value = result
+        result = self.that._scan(context, end)
+        if result is None:
+            return None
+
+        return result[0], value
+
+    def first(self):
+        return sequence_first([self.this, self.that])
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class LabelParser(AbstractParser):
+    """ Reports failures of `this` as failing to find `expected`. """
+    def __init__(self, this, expected):
+        self.this = this
+        self.expected = expected
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            return context.fail(start, self.expected)
+
+        return result
+
+    def first(self):
+        return self.this.first()
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class MapParser(AbstractParser):
+    """ Applies `function` on the result of `this`. """
+    def __init__(self, this, function):
+        self.this = this
+        self.function = function
+        self.expected = None
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            return None
+
+        end, value = result
+        return end, self.function(value)
+
+    def first(self):
+        return self.this.first()
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class GuardParser(AbstractParser):
+    """ Fails with `desc` unless the result of `this` satisfies `predicate`. """
+    def __init__(self, this, predicate, desc):
+        self.this = this
+        self.predicate = predicate
+        self.desc = desc
+        self.expected = None
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            return None
+
+        if self.predicate(result[1]):
+            return result
+        else:
+            return context.fail(start, self.desc)
+
+    def first(self):
+        return self.this.first()
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class BetweenParser(AbstractParser):
+    """
+    Applies `this` between `minimum` and `maximum` times
+    and returns a list of values.
+    """
+    def __init__(self, this, minimum, maximum):
+        self.this = this
+        self.minimum = minimum
+        self.maximum = maximum
+        self.expected = None
+
+    def _scan(self, context, start):
+        if context.budget is not None:
+            context.budget.step(self, context, start)
+
+        this = self.this
+        maximum = self.maximum
+
+        values = []
+        current = start
+
+        while len(values) < maximum:
+            result = this._scan(context, current)
+
+            if result is None:
+                if len(values) >= self.minimum and not context.committed:
+                    break
+                return None
+
+            current, value = result
+            values.append(value)
+
+        return current, values
+
+    def iterparse(self, text, start=0, context=None):
+        if context is None:
+            context = ParseContext(text)
+
+        this = self.this
+
+        count = 0
+        current = start
+
+        while count < self.maximum:
+            result = this._scan(context, current)
+
+            if result is None:
+                if count >= self.minimum and not context.committed:
+                    return
+                raise context.error()
+
+            current, value = result
+            count += 1
+
+            # there is no backtracking into the items already found
+            context.memo = None
+            yield value
+
+    def first(self):
+        chars, nullable = self.this.first()
+        return chars, nullable or self.minimum == 0
+
+    def literal_prefix(self):
+        return self.this.literal_prefix() if self.minimum > 0 else ""
+
+
+class Memo(object):
+    """
+    A table of parse results for packrat parsing. Both successes and
+    failures are stored, keyed by parser, input and position. When more
+    than `max_size` results are stored, the least recently used ones are
+    evicted. The table may be shared between threads.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.table = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """ The entry stored under `key`, or `None` if there is none. """
+        with self.lock:
+            entry = self.table.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+            else:
+                # re-insert to mark as most recently used
+                self.table[key] = entry
+                self.hits += 1
+
+        return entry
+
+    def store(self, key, entry):
+        """ Store `entry` under `key`, evicting old entries if necessary. """
+        with self.lock:
+            self.table[key] = entry
+
+            if self.max_size is not None:
+                while len(self.table) > self.max_size:
+                    self.table.popitem(last=False)
+                    self.evictions += 1
+
+    def clear(self):
+        """ Forget all the stored results and reset the counters. """
+        with self.lock:
+            self.table.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getstate__(self):
+        # the results are keyed by the identity of their inputs,
+        # so only the configuration survives pickling
+        return {"max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_size"])
+
+    def __repr__(self):
+        return ("Memo(size {}, hits {}, misses {}, evictions {})"
+                .format(len(self.table), self.hits,
+                        self.misses, self.evictions))
+
+
+class MemoParser(AbstractParser):
+    """
+    A parser that looks up its results in a :class:`Memo` table, or in the
+    `memo` of the :class:`ParseContext` if it has no table of its own.
+    """
+    def __init__(self, this, memo=None):
+        self.this = this
+        self.memo = memo
+        self.expected = this.expected
+
+    def _scan(self, context, start):
+        if self.memo is None:
+            return self.scan_per_parse(context, start)
+
+        text = context.text
+
+        # the input is kept alive by the entry, so its `id` stays unique
+        key = (self.this, id(text), start)
+        entry = self.memo.lookup(key)
+
+        if entry is None:
+            result = self.this._scan(context, start)
+            self.memo.store(key, (text, result, context.failure,
+                                  context.committed))
+            return result
+
+        _, result, failure, committed = entry
+        if result is None:
+            context.failure = failure
+            context.committed = committed
+        return result
+
+    def scan_per_parse(self, context, start):
+        """ Look up the results in the memo of the `context`. """
+        table = context.memo
+        if table is None:
+            table = context.memo = {}
+
+        key = (self.this, start)
+        entry = table.get(key)
+
+        if entry is None:
+            result = self.this._scan(context, start)
+            table[key] = (result, context.failure, context.committed)
+            return result
+
+        result, failure, committed = entry
+        if result is None:
+            context.failure = failure
+            context.committed = committed
+        return result
+
+    def first(self):
+        return self.this.first()
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
 def merge_parser_lists(this, that, kind):
     """ Merge two lists containing parsers. """
     if isinstance(this, kind):
@@ -311,8 +1228,100 @@ def merge_expected(this, that, conjunction):
         return that.expected
     elif that.expected is None:
         return this.expected
-    else:
-        return this.expected + conjunction + that.expected
+
+    items = []
+    for expected in [this.expected, that.expected]:
+        if (isinstance(expected, Expected) and
+                expected.conjunction == conjunction):
+            items.extend(expected.items)
+        else:
+            items.append(expected)
+
+    return Expected(items, conjunction)
+
+
+def sequence_first(parsers):
+    """ The FIRST set of `parsers` applied one after another. """
+    chars = frozenset()
+
+    for this in parsers:
+        first, nullable = this.first()
+
+        if chars is not None:
+            chars = None if first is None else chars | first
+
+        if not nullable:
+            return chars, False
+
+    return chars, True
+
+
+def choice_first(parsers):
+    """ The FIRST set of a choice between `parsers`. """
+    chars = frozenset()
+    nullable = False
+
+    for this in parsers:
+        first, this_nullable = this.first()
+
+        if chars is not None:
+            chars = None if first is None else chars | first
+        nullable = nullable or this_nullable
+
+    return chars, nullable
+
+
+def dispatch_table(parsers):
+    """
+    Sort `parsers` by their FIRST sets. Returns a table from characters
+    to the parsers that may succeed there, the parsers that may succeed at
+    any other character, and the ones that may succeed at the end of input,
+    all in the original order.
+    """
+    firsts = [(this,) + this.first() for this in parsers]
+
+    chars = set()
+    for _, first, _ in firsts:
+        if first is not None:
+            chars |= first
+
+    table = {}
+    for char in chars:
+        table[char] = [this for this, first, nullable in firsts
+                       if nullable or first is None or char in first]
+
+    others = [this for this, first, nullable in firsts
+              if nullable or first is None]
+    at_end = [this for this, _, nullable in firsts if nullable]
+
+    return table, others, at_end
+
+
+def dispatch(choice, context, start):
+    """
+    The alternatives of `choice` worth trying at `start`, looked up in its
+    dispatch table. The table is built on first use rather than by the
+    constructor, since ``|`` builds a new choice for every alternative.
+    """
+    if choice.table is None:
+        table, choice.others, choice.at_end = dispatch_table(choice.parsers)
+        # set last, as other threads may be reading the choice
+        choice.table = table
+
+    if not choice.table:
+        return choice.parsers
+
+    text = context.text
+    if start >= len(text):
+        return choice.at_end
+
+    char = text[start]
+    if isinstance(char, unicode):
+        # FIRST sets hold byte characters, while the predicates of spans
+        # may take unicode ones they do not list
+        return choice.parsers
+
+    return choice.table.get(char, choice.others)
 
 
 class ChoiceNoBacktrackParser(AbstractParser):
@@ -324,17 +1333,40 @@ class ChoiceNoBacktrackParser(AbstractParser):
         self.expected = merge_expected(this, that, " or ")
         self.parsers = merge_parser_lists(this, that, ChoiceNoBacktrackParser)
 
-    def scan(self, text, start=0):
-        for this in self.parsers:
-            try:
-                return this.scan(text, start)
-            except Failure as failure:
-                if failure.start != start:
-                    raise Failure
-                else:
-                    pass
+        # built on first use, see `dispatch`
+        self.table = None
+        self.others = None
+        self.at_end = None
+
+    def _scan(self, context, start):
+        budget = context.budget
+        if budget is not None:
+            budget.step(self, context, start)
+
+        parsers = dispatch(self, context, start)
 
-        raise Failure(text, start, self.expected)
+        for this in parsers:
+            result = this._scan(context, start)
+            if result is not None:
+                return result
+
+            # the alternative consumed input or passed a cut
+            if context.committed or context.failure[0] != start:
+                context.committed = False
+                return None
+
+            if budget is not None:
+                budget.backtrack(context, start)
+
+        if len(parsers) < len(self.parsers):
+            return context.fail(start, self.expected)
+
+        # the alternatives have already been tracked
+        context.failure = (start, self.expected)
+        return None
+
+    def first(self):
+        return choice_first(self.parsers)
 
 
 class ChoiceParser(AbstractParser):
@@ -346,14 +1378,40 @@ class ChoiceParser(AbstractParser):
         self.expected = merge_expected(this, that, " or ")
         self.parsers = merge_parser_lists(this, that, ChoiceParser)
 
-    def scan(self, text, start=0):
-        for this in self.parsers:
-            try:
-                return this.scan(text, start)
-            except Failure:
-                pass
+        # built on first use, see `dispatch`
+        self.table = None
+        self.others = None
+        self.at_end = None
+
+    def _scan(self, context, start):
+        budget = context.budget
+        if budget is not None:
+            budget.step(self, context, start)
 
-        raise Failure(text, start, self.expected)
+        parsers = dispatch(self, context, start)
+
+        for this in parsers:
+            result = this._scan(context, start)
+            if result is not None:
+                return result
+
+            # the alternative passed a cut
+            if context.committed:
+                context.committed = False
+                return None
+
+            if budget is not None:
+                budget.backtrack(context, start)
+
+        if len(parsers) < len(self.parsers):
+            return context.fail(start, self.expected)
+
+        # the alternatives have already been tracked
+        context.failure = (start, self.expected)
+        return None
+
+    def first(self):
+        return choice_first(self.parsers)
 
 
 class SequenceParser(AbstractParser):
@@ -362,15 +1420,524 @@ class SequenceParser(AbstractParser):
         self.expected = merge_expected(this, that, " followed by ")
         self.parsers = merge_parser_lists(this, that, SequenceParser)
 
-    def scan(self, text, start=0):
-        success = self.parsers[0].scan(text, start)
-        result = success.value
+    def _scan(self, context, start):
+        parsers = self.parsers
+
+        result = parsers[0]._scan(context, start)
+        if result is None:
+            return None
+
+        end, value = result
+        if isinstance(value, list):
+            # do not extend a list that may be shared, say, by a memo table
+            value = list(value)
+
+        for index in range(1, len(parsers)):
+            result = parsers[index]._scan(context, end)
+            if result is None:
+                return None
+
+            end, following = result
+            value += following
+
+        return end, value
+
+    def first(self):
+        return sequence_first(self.parsers)
+
+    def literal_prefix(self):
+        return self.parsers[0].literal_prefix()
 
-        for this in self.parsers[1:]:
-            success = this.scan(text, success.end)
-            result += success.value
 
-        return Success(text, start, success.end, result)
+class CommitParser(AbstractParser):
+    """
+    Applies `this`, which follows a cut: should it fail, the failure is
+    marked as committed in the context. Should it succeed, the results
+    memoized for the parse before the cut are released.
+    """
+    def __init__(self, this):
+        self.this = this
+        self.expected = this.expected
+
+    def _scan(self, context, start):
+        result = self.this._scan(context, start)
+        if result is None:
+            context.committed = True
+        elif context.memo:
+            context.release(start)
+        return result
+
+    def first(self):
+        return self.this.first()
+
+    def literal_prefix(self):
+        return self.this.literal_prefix()
+
+
+class OperatorTable(object):
+    """
+    The operators of one kind for an :class:`OperatorParser`: a dictionary
+    of `entries` from operator parsers to what is known about them, and a
+    dispatch table over the operator `parsers`, as a choice has.
+    """
+    def __init__(self, entries):
+        self.entries = OrderedDict(entries)
+        self.parsers = list(self.entries)
+
+        # built on first use, see `dispatch`
+        self.table = None
+        self.others = None
+        self.at_end = None
+
+    def longest(self, context, start):
+        """
+        The outcome of the operator that consumes the most at `start`,
+        the earliest one in case of a tie, and its entry. `None` if no
+        operator matches.
+        """
+        best = None
+        for this in dispatch(self, context, start):
+            result = this._scan(context, start)
+            if result is not None and (best is None or
+                                       result[0] > best[0][0]):
+                best = result, self.entries[this]
+        return best
+
+
+class OperatorParser(AbstractParser):
+    """
+    Parses expressions of `operand` and operators in one pass, by the
+    binding powers of the operators (Pratt parsing). Operators are given as
+    ``(parser, power)`` pairs: `prefix` operators, and left-associative
+    `infix` and right-associative `right` binary operators. Operators with
+    higher powers bind tighter, and a prefix operator applies to all that
+    binds tighter than it. Where more than one operator matches, the longest
+    wins.
+
+    An operator and its operands are returned as an ``(operator, operand)``
+    or ``(operator, left, right)`` tuple of their values, and a lone operand
+    as its value. When a binary operator is not followed by an operand, the
+    expression ends before the operator.
+    """
+    def __init__(self, operand, prefix, infix, right):
+        self.operand = operand
+        self.prefix = OperatorTable(prefix)
+        self.infix = OperatorTable([(this, (power, False))
+                                    for this, power in infix] +
+                                   [(this, (power, True))
+                                    for this, power in right])
+        self.expected = operand.expected
+
+    def _scan(self, context, start):
+        if context.budget is not None:
+            context.budget.step(self, context, start)
+
+        return self.expression(context, start, 0)
+
+    def expression(self, context, start, minimum):
+        """ Parse operators binding with at least the power `minimum`. """
+        result = self.prefixed(context, start)
+        if result is None:
+            if context.committed:
+                return None
+            result = self.operand._scan(context, start)
+            if result is None:
+                return None
+
+        end, left = result
+
+        while True:
+            found = self.infix.longest(context, end)
+            if found is None:
+                break
+
+            (after, operator), (power, right) = found
+            if power < minimum:
+                break
+
+            result = self.expression(context, after,
+                                     power if right else power + 1)
+            if result is None:
+                if context.committed:
+                    return None
+                break
+
+            end, operand = result
+            left = (operator, left, operand)
+
+        return end, left
+
+    def prefixed(self, context, start):
+        """ Parse a prefix operator and its operand. """
+        found = self.prefix.longest(context, start)
+        if found is None:
+            return None
+
+        (after, operator), power = found
+        result = self.expression(context, after, power + 1)
+        if result is None:
+            return None
+
+        end, operand = result
+        return end, (operator, operand)
+
+    def first(self):
+        return choice_first(self.prefix.parsers + [self.operand])
+
+
+class FailParser(AbstractParser):
+    """ A parser that fails unconditionally, expecting `desc`. """
+    def __init__(self, desc):
+        self.expected = desc
+
+    def _scan(self, context, start):
+        return context.fail(start, self.expected)
+
+    def first(self):
+        return frozenset(), False
+
+
+class SucceedParser(AbstractParser):
+    """ A parser that succeeds with `value` without consuming input. """
+    def __init__(self, value):
+        self.value = value
+        self.expected = "never"
+
+    def _scan(self, context, start):
+        return start, self.value
+
+    def first(self):
+        return frozenset(), True
+
+
+class EOFParser(AbstractParser):
+    """ Parses `None` at the end of input, fails otherwise. """
+    def __init__(self):
+        self.expected = "<EOF>"
+
+    def _scan(self, context, start):
+        if start >= len(context.text):
+            context.hit_end = True
+            return start, None
+        else:
+            return context.fail(start, self.expected)
+
+    def first(self):
+        # succeeds without consuming, albeit only at the end
+        return frozenset(), True
+
+
+class FeedParser(object):
+    """
+    Applies `this` repeatedly to input that arrives in chunks, returning
+    each value once more input could no longer change it. Only the
+    unconsumed input is kept: in `buffer`, which starts out as `empty`
+    (such as ``""`` or ``[]``), followed by the `chunks` fed since the last
+    attempt. `offset` tells how much input was consumed before the
+    `buffer`. Failures report positions within the `buffer`.
+
+    An item that needs more input is only tried again once the input
+    pending has doubled, so that an item spanning many chunks is not parsed
+    from its start after every one of them. Parsing it takes time linear in
+    its size, but it may be returned a few chunks after it is complete.
+    """
+    def __init__(self, this, empty=""):
+        self.this = this
+        self.buffer = empty
+        self.offset = 0
+        self.chunks = []
+
+        # the amount of input pending when the next attempt is worthwhile
+        self.size = len(empty)
+        self.wanted = 0
+
+    def feed(self, chunk):
+        """
+        Append `chunk` to the input and return the list of values
+        completed so far.
+        """
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+        if self.size < self.wanted:
+            return []
+
+        return self._drain(False)
+
+    def close(self):
+        """
+        Signal the end of the input and return the list of remaining
+        values. Raises :class:`Failure` if not all input could be parsed.
+        """
+        values = self._drain(True)
+
+        if len(self.buffer) > 0:
+            raise Failure(self.buffer, 0, "<EOF>")
+
+        return values
+
+    def _drain(self, final):
+        """
+        Apply `this` as long as it consumes input, and the outcome is
+        known for sure unless the input is `final`.
+        """
+        this = self.this
+        text = self.join()
+
+        values = []
+        start = 0
+
+        while start < len(text):
+            context = ParseContext(text)
+            result = this._scan(context, start)
+
+            if context.hit_end and not final:
+                break
+
+            if result is None:
+                self.discard(start)
+                raise context.error()
+
+            end, value = result
+            if end == start:
+                break
+
+            values.append(value)
+            start = end
+
+        self.discard(start)
+        self.wanted = 2 * len(self.buffer)
+        return values
+
+    def join(self):
+        """ Append the `chunks` to the `buffer` in one go. """
+        if self.chunks:
+            parts = [self.buffer] + self.chunks
+            if isinstance(self.buffer, (basestring, bytearray)):
+                self.buffer = self.buffer[:0].join(parts)
+            else:
+                self.buffer = type(self.buffer)(chain(*parts))
+            self.chunks = []
+
+        return self.buffer
+
+    def discard(self, end):
+        """ Forget the input consumed up to `end`. """
+        if end > 0:
+            self.buffer = self.buffer[end:]
+            self.offset += end
+            self.size -= end
+
+
+class ProfileStats(object):
+    """ The statistics of the parsers profiled under one name. """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+        self.backtracks = 0
+        self.consumed = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+
+        # number of calls in progress, to count recursive ones once
+        self.active = 0
+
+
+def profile_name(prsr):
+    """
+    The name `prsr` is profiled under: its label, the name of its rule or
+    parsing function, or the description of a primitive parser. Other combinators
+    are `None`, and their time counts for the named parser applying them.
+    """
+    if (isinstance(prsr, (LabelParser, ParsingFunction, Rule)) or
+            not (hasattr(prsr, "this") or hasattr(prsr, "parsers"))):
+        return name_of(prsr)
+    else:
+        return None
+
+
+def all_subclasses(cls):
+    """ `cls` and all the classes derived from it. """
+    result = [cls]
+    for subclass in cls.__subclasses__():
+        result.extend(all_subclasses(subclass))
+    return result
+
+
+class Profiler(object):
+    """
+    Collects :class:`ProfileStats` for the parsers applied while it is
+    enabled, keyed by :func:`profile_name`: the number of calls, successes
+    and failures, the failures that had to backtrack from past their start,
+    the input consumed, and the time spent including (total) and excluding
+    (self) other named parsers.
+
+    Enabling replaces the `_scan` methods of all parser classes, and the
+    handlers that :func:`engine.evaluate <linter.engine.evaluate>` applies
+    combinators with, by instrumented versions, for all threads; disabling
+    restores them, so there is no overhead at all when not profiling. Use
+    it as a context manager, or call `enable` and `disable`.
+    """
+    def __init__(self):
+        self.stats = {}
+        self.saved = {}
+        self.saved_handlers = {}
+
+        # the time spent in named parsers called by the running ones
+        self.children = []
+
+    def enable(self):
+        """ Start profiling all parsers. """
+        # imported here, as the engine is built on this module
+        from .engine import HANDLERS
+
+        for cls in all_subclasses(AbstractParser):
+            if "_scan" in cls.__dict__ and cls not in self.saved:
+                self.saved[cls] = cls.__dict__["_scan"]
+                cls._scan = self.instrument(cls.__dict__["_scan"])
+
+        if not self.saved_handlers:
+            self.saved_handlers = dict(HANDLERS)
+            for cls, handler in self.saved_handlers.items():
+                HANDLERS[cls] = self.instrument_handler(handler)
+
+    def disable(self):
+        """ Stop profiling and restore the parser classes. """
+        from .engine import HANDLERS
+
+        for cls, scan in self.saved.items():
+            cls._scan = scan
+        self.saved.clear()
+
+        HANDLERS.update(self.saved_handlers)
+        self.saved_handlers = {}
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *_):
+        self.disable()
+
+    def instrument(self, scan):
+        """ A version of the `_scan` method `scan` that keeps statistics. """
+        profiler = self
+
+        def profiled_scan(prsr, context, start):
+            """ Apply the parser, timing it if it has a name. """
+            name = profile_name(prsr)
+            if name is None:
+                return scan(prsr, context, start)
+            return profiler.measure(name, scan, prsr, context, start)
+
+        return profiled_scan
+
+    def instrument_handler(self, handler):
+        """
+        A version of the engine `handler` whose frames keep statistics.
+        """
+        profiler = self
+
+        def profiled_handler(node, context, start):
+            """ The frame applying `node`, timed if it has a name. """
+            frame = handler(node, context, start)
+            name = profile_name(node)
+            if name is None:
+                return frame
+            return profiler.measure_frame(name, frame, context, start)
+
+        return profiled_handler
+
+    def measure_frame(self, name, frame, context, start):
+        """
+        Pass on the requests of the engine `frame` and the outcomes sent to
+        it, and record it under `name` like `measure` does.
+        """
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ProfileStats(name)
+
+        children = self.children
+        children.append(0.0)
+        stats.active += 1
+        started = default_timer()
+
+        try:
+            node, pos = next(frame)
+            while node is not None:
+                node, pos = frame.send((yield node, pos))
+        finally:
+            elapsed = default_timer() - started
+            stats.active -= 1
+            inner = children.pop()
+
+        self.record(stats, elapsed, inner, pos, context, start)
+        yield None, pos
+
+    def measure(self, name, scan, prsr, context, start):
+        """ Apply `prsr` with `scan` and record it under `name`. """
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ProfileStats(name)
+
+        children = self.children
+        children.append(0.0)
+        stats.active += 1
+        started = default_timer()
+
+        try:
+            result = scan(prsr, context, start)
+        finally:
+            elapsed = default_timer() - started
+            stats.active -= 1
+            inner = children.pop()
+
+        self.record(stats, elapsed, inner, result, context, start)
+        return result
+
+    def record(self, stats, elapsed, inner, result, context, start):
+        """
+        Add an application that took `elapsed` seconds, `inner` of them in
+        other named parsers, and had the outcome `result`, to `stats`.
+        """
+        children = self.children
+
+        stats.calls += 1
+        stats.self_time += elapsed - inner
+        if stats.active == 0:
+            stats.total_time += elapsed
+        if children:
+            children[-1] += elapsed
+
+        if result is None:
+            stats.failures += 1
+            if context.failure[0] > start:
+                stats.backtracks += 1
+        else:
+            stats.successes += 1
+            stats.consumed += result[0] - start
+
+    def report(self, limit=20):
+        """
+        A table of the `limit` parsers that took the most time, not
+        counting the named parsers they applied.
+        """
+        stats = sorted(self.stats.values(),
+                       key=lambda entry: entry.self_time, reverse=True)
+
+        lines = ["{:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8}  {}"
+                 .format("calls", "success", "failure", "backtrack",
+                         "consumed", "total s", "self s", "parser")]
+        for entry in stats[:limit]:
+            lines.append("{:>9} {:>9} {:>9} {:>9} {:>9} {:>8.3f} {:>8.3f}  {}"
+                         .format(entry.calls, entry.successes,
+                                 entry.failures, entry.backtracks,
+                                 entry.consumed, entry.total_time,
+                                 entry.self_time, abbreviate(entry.name, 40)))
+
+        return "\n".join(lines)
 
 
 def fail(desc):
@@ -378,11 +1945,7 @@ def fail(desc):
     A parser that fails without consuming input by raising
     an exception with message `desc`.
     """
-    @parser(desc)
-    def inner(text, start):
-        """ Fail unconditionally. """
-        raise Failure(text, start, desc)
-    return inner
+    return FailParser(desc)
 
 
 def succeed(value):
@@ -391,27 +1954,20 @@ def succeed(value):
     and returns given `value`.
     Equivalent to ``return`` in Haskell.
     """
-    @parser("never")
-    def inner(text, start):
-        """ Succeed unconditionally. """
-        return Success(text, start, start, value)
-    return inner
+    return SucceedParser(value)
 
 
-def _eof():
-    """ Only matches EOF. """
-    @parser("<EOF>")
-    def inner(text, start):
-        """ Parse `None` when EOF, fail otherwise. """
-        if start >= len(text):
-            return Success(text, start, start, None)
-        else:
-            raise Failure(text, start, "<EOF>")
-    return inner
+#: a parser to detect EOF
+EOF = EOFParser()
 
 
-#: a parser to detect EOF
-EOF = _eof()
+def operators(operand, prefix=(), infix=(), right=()):
+    """
+    A parser of expressions of `operand` and the `prefix`, `infix` and
+    right-associative `right` operators, given as lists of ``(parser,
+    power)`` pairs, in one pass. See :class:`OperatorParser`.
+    """
+    return OperatorParser(operand, prefix, infix, right)
 
 
 def singleton(string):
@@ -435,8 +1991,4 @@ def join(list_of_str):
 
 def matches(this, text, start=0):
     """ Returns whether the parser `this` matches the `text`. """
-    try:
-        _ = this.scan(text, start)
-        return True
-    except Failure:
-        return False
+    return this._scan(ParseContext(text), start) is not None
@@ -0,0 +1,49 @@
+"""
+Snapshots of parser graphs, to send built grammars to worker processes or
+to load them from disk instead of building them again.
+
+Parsers are plain objects and pickle as they are, as long as the functions
+they hold are defined at the top level of a module. A snapshot is such a
+pickle, compressed and marked with a format version. Memo tables lose their
+results on the way, and compiled parsers are compiled again when loaded.
+"""
+import os
+import zlib
+from cPickle import dumps as pickle_dumps, loads as pickle_loads
+from cPickle import HIGHEST_PROTOCOL
+
+#: marks the format of snapshots, so that stale ones are recognized
+MAGIC = "linter-snapshot 1\n"
+
+
+class SnapshotError(Exception):
+    """ Raised for data that is not a snapshot of this format. """
+    pass
+
+
+def dumps(prsr):
+    """ A snapshot of the parser `prsr` as a string. """
+    return MAGIC + zlib.compress(pickle_dumps(prsr, HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    """ The parser in the snapshot `data`. """
+    if not data.startswith(MAGIC):
+        raise SnapshotError("not a parser snapshot of this version")
+
+    return pickle_loads(zlib.decompress(data[len(MAGIC):]))
+
+
+def save(prsr, path):
+    """ Write a snapshot of `prsr` to the file `path`. """
+    # write, then rename, so that no reader sees a partial file
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as snapshot_file:
+        snapshot_file.write(dumps(prsr))
+    os.rename(temporary, path)
+
+
+def load(path):
+    """ The parser in the snapshot file `path`. """
+    with open(path, "rb") as snapshot_file:
+        return loads(snapshot_file.read())
@@ -1,8 +1,37 @@
 """ Basic tests for parser combinators. """
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
 
-from .. import exact, Failure, EOF, singleton, succeed, regex
-from .. import spaces, word, digit, digits
+from .. import exact, Failure, EOF, singleton, succeed, regex, Memo
+from .. import Success, matches, location, parser, join
+from ..parsers import AbstractParser, ParseContext
+from ..optimizer import optimize
+from ..compiler import compile_parser
+from ..engine import iterative
+from ..lint import lint, backtracking_depth
+from .. import snapshot
+from ..benchmark.combinators import benchmarks, regressions, superlinear
+from ..tokens import ExactParser, OneOfParser
+from .. import spaces, word, digit, digits, span, digit_chars, one_of
+from .. import none_of, interned, FeedParser, Rule, concat, satisfies
+from .. import ParseBudget, ParseBudgetExceeded, Profiler
+from .. import Lexer, Token, one_of_tags, none_of_tags, switch_tag
+from .. import wildcard, separated_by, operators
+from ..fortran import Grammar, block_parser, program_unit_parser
+from ..fortran import logical_line_parser, parse_into_logical_lines
+from ..fortran import read_file, OuterBlock, RawLine
+from ..fortran import parse_source, line_number
+
+
+@parser
+def bracketed(text, start):
+    """ A parsing function at the top level, to be pickled. """
+    return (exact("[") >> digits << exact("]")).scan(text, start)
 
 
 class TestBasic(unittest.TestCase):
@@ -77,6 +106,26 @@ class TestBasic(unittest.TestCase):
 
         self.match(test, text, "police", len("interpol"))
 
+    def test_first(self):
+        """ Test FIRST sets and choices dispatching on them. """
+        self.assertEqual(exact("ab").first(), (frozenset("a"), False))
+        self.assertEqual((-exact("a") + one_of("bc")).first(),
+                         (frozenset("abc"), False))
+        self.assertEqual((~digit + exact("x") | succeed(1)).first(),
+                         (frozenset("0123456789x"), True))
+        self.assertEqual((word | regex("a")).first(), (None, True))
+
+        test = (exact("ab") | word // len | digits | succeed(None) |
+                exact("a") >> EOF)
+        self.match(test, "ab", "ab", 2)
+        self.match(test, "bac", 3, 3)
+        self.match(test, "12", "12", 2)
+        self.match(test, "!", None, 0)
+        self.match(test, "", None, 0)
+
+        test = exact("ab") | digits | exact("b")
+        self.mismatch(test, "ac", "'ab' or digits or 'b'", 0)
+
     def test_label(self):
         """ Test labelled parsers and their fail messages. """
         text = "rising sun"
@@ -135,6 +184,30 @@ class TestBasic(unittest.TestCase):
         test = digit + digit
         self.match(test, text, text, len(text))
 
+    def test_span(self):
+        """ Test runs of characters from a character class. """
+        text = "1234567 "
+
+        self.match(span(digit_chars, "digits", 0, 5), text, "12345", 5)
+        self.match(span(digit_chars, "digits", 0) + spaces, text, text)
+        self.match(span("[a-z]", "letters", 0), text, "", 0)
+
+        self.mismatch(span("[a-z]", "letters"), text, "letters", 0)
+        self.mismatch(digits >> word, text, "word", 7)
+
+    def test_span_items(self):
+        """ Test runs of characters in unicode strings and lists. """
+        for test in [word, word | digits, compile_parser(word | digits)]:
+            self.match(test, u"caf\xe9!", u"caf\xe9", 4)
+            self.match(test, u"\xe9t\xe9", u"\xe9t\xe9", 3)
+        self.assertEqual(word.search(u"1 \xe9t\xe9").start, 2)
+
+        for test in [digit, compile_parser(digit)]:
+            self.match(test, ["1", "2"], "1", 1)
+        self.match(digits, ["1", "2", "x"], "12", 2)
+        self.match(span("[^x]", "not x", 0), [u"a", u"b", u"x"], u"ab", 2)
+        self.mismatch(spaces, [u"a"], "whitespaces", 0)
+
     def test_regex(self):
         """ Test regex parsers. """
         text = "email me at someone@example.com"
@@ -143,6 +216,677 @@ class TestBasic(unittest.TestCase):
         match = test.scan(text)
         self.assertEqual(match.value.groups(0), ("someone", "example", "com"))
 
+    def test_memoize(self):
+        """ Test packrat memoization of parse results. """
+        text = "AAAB"
+
+        memo = Memo()
+        test = exact("A").memoize(memo)
+        self.match(~test + exact("B"), text, ['A'] * 3 + ['B'], 4)
+        self.match(~test + exact("B"), text, ['A'] * 3 + ['B'], 4)
+        self.assertEqual((memo.hits, memo.misses), (4, 4))
+
+        self.mismatch(test, text[3:], repr('A'), 0)
+
+        memo = Memo(max_size=2)
+        test = +exact("A").memoize(memo)
+        self.match(test, text, ['A'] * 3, 3)
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.evictions, 2)
+
+    def test_public_protocol(self):
+        """ Test parsers implementing only the public `scan`. """
+        class Dot(AbstractParser):
+            """ Matches a single dot. """
+            expected = "dot"
+
+            def scan(self, text, start=0):
+                """ Match the dot, or raise a failure. """
+                if text[start:start + 1] == ".":
+                    return Success(text, start, start + 1, ".")
+                raise Failure(text, start, self.expected)
+
+        text = "..!"
+
+        self.match(+Dot() + exact("!"), text, ['.', '.', '!'], 3)
+        self.mismatch(+Dot() >> EOF, text, "<EOF>", 2)
+        self.assertTrue(matches(Dot(), text))
+        self.assertFalse(matches(Dot(), text, 2))
+
+    def test_failure_report(self):
+        """ Test failure locations and the furthest expectations. """
+        text = "one\ntwo\nthree"
+
+        self.assertEqual(location(text, 0), "1:1")
+        self.assertEqual(location(text, 3), "1:4")
+        self.assertEqual(location(text, 4), "2:1")
+        self.assertEqual(location(text, 10), "3:3")
+
+        # the line breaks are only found for the failures that need them
+        context = ParseContext(text)
+        self.assertIsNone(context.lines)
+        self.assertIsNone(exact("two")._scan(context, 0))
+        error = context.error()
+        self.assertIsNone(error.lines.breaks)
+        self.assertEqual(str(error), "expected 'two' at 1:1")
+        self.assertEqual(error.lines.breaks, [3, 7])
+        self.assertIs(context.error().lines, error.lines)
+
+        test = (exact("one\ntwo\nth") + exact("ree!") |
+                exact("one") + exact("!"))
+        with self.assertRaises(Failure) as failure:
+            test.scan(text)
+
+        self.assertEqual(str(failure.exception),
+                         "expected 'one\\ntwo\\nth' followed by 'ree!' or "
+                         "'one' followed by '!' at 1:1")
+        self.assertEqual(failure.exception.furthest, len("one\ntwo\nth"))
+        self.assertEqual(failure.exception.expectations, [repr("ree!")])
+        self.assertTrue(failure.exception.explain()
+                        .endswith("furthest at 3:3 expected 'ree!'"))
+
+    def test_optimize(self):
+        """ Test that optimized parsers are simpler but equivalent. """
+        test = optimize(exact("a") + (exact("b") % "b") + exact("c"))
+        self.assertIsInstance(test, ExactParser)
+        self.match(test, "abcd", "abc", 3)
+
+        test = optimize(exact("x") | exact("y") | one_of("z") | word)
+        self.assertIsInstance(test.parsers[0], OneOfParser)
+        self.assertEqual(len(test.parsers), 2)
+        self.match(test, "zz", "z", 1)
+        self.match(test, "ab", "ab", 2)
+
+        test = optimize((exact("a") + exact("b")) // len // str // int)
+        self.assertIsInstance(test.this, ExactParser)
+        self.match(test, "ab", 2, 2)
+
+        grammar = (+(exact("1") | exact("2") | spaces) // "".join +
+                   (exact("x") % "ex") * 2 // "-".join)
+        for text in ["12 1xx", "1 2 xx!", "x", " xxx"]:
+            self.assertEqual(matches(grammar, text),
+                             matches(optimize(grammar), text))
+            if matches(grammar, text):
+                self.assertEqual(grammar.parse(text),
+                                 optimize(grammar).parse(text))
+
+    def test_optimize_no_backtrack(self):
+        """ Test that optimizing keeps the choices without backtracking. """
+        def outcome(prsr, text):
+            """ The end and value of a match, or where it failed. """
+            try:
+                success = prsr.scan(text)
+            except Failure as failure:
+                return failure.start
+            return success.end, success.value
+
+        grammars = [((exact("a") + word) % "aw") ^ exact("a1"),
+                    (exact("a") + exact("b")) ^ exact("ac"),
+                    ((exact("x") | exact("y")) % "xy" + exact("!")) ^ digits,
+                    +((exact("a") + exact("b") + exact("c")) % "abc" ^
+                      exact("ab") ^ exact("a")) // join]
+
+        for grammar in grammars:
+            for text in ["a1", "ac", "ab", "abc", "x!", "x1", "1", "abab"]:
+                self.assertEqual(outcome(optimize(grammar), text),
+                                 outcome(grammar, text))
+
+        test = optimize(((exact("x") | exact("y")) % "xy") ^ digits)
+        self.assertIsInstance(test.parsers[0], OneOfParser)
+
+    def test_compile(self):
+        """ Test that compiled parsers behave like the interpreted ones. """
+        @parser
+        def parenthesized(text, start):
+            """ An opaque parsing function. """
+            return (exact("(") >> grammar << exact(")")).scan(text, start)
+
+        item = (parenthesized |
+                (word // len | digits // int | -exact("-") // join) % "item")
+        grammar = (item // singleton + ~(exact(",") >> item)).guard(
+            lambda l: l, "items")
+
+        for test in [grammar, grammar << EOF]:
+            compiled = compile_parser(test)
+
+            for text in ["abc,12,-", "(a,(1,2)),x", "1,", "(1,", "a b", ""]:
+                self.assertEqual(matches(test, text), matches(compiled, text))
+                try:
+                    self.assertEqual(test.parse(text), compiled.parse(text))
+                except Failure as failure:
+                    self.mismatch(compiled, text,
+                                  failure.expected, failure.start)
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for _ in range(2):
+                compiled = compile_parser(grammar, cache_dir)
+                self.match(compiled, "x,(y)", [1, [1]], 5)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_interned(self):
+        """ Test that the token factories return shared parsers. """
+        self.assertIs(exact("ab"), exact("ab"))
+        self.assertIsNot(exact("ab"), exact("ab", True))
+        self.assertIs(one_of("xy"), one_of("xy"))
+        self.assertIs(none_of("xy"), none_of("xy"))
+        self.assertIs(span(digit_chars, "digit", 2),
+                      span(digit_chars, "digit", 2))
+
+        self.match(none_of("xy"), "za", "z", 1)
+        self.mismatch(none_of("xy"), "yz", "none of xy", 0)
+
+        @interned
+        def pair(first, second):
+            """ Two parsers in sequence. """
+            return first + second
+
+        grammar = pair(exact("a"), digits)
+        self.assertIs(grammar, pair(exact("a"), digits))
+        self.assertIsNot(pair([1], [2]), pair([1], [2]))
+
+    def test_iterparse(self):
+        """ Test yielding repeated items as they are recognized. """
+        self.assertEqual(list(digit.many().iterparse("12a")), ["1", "2"])
+        self.assertEqual(list((digit * 2).iterparse("123")), ["1", "2"])
+        self.assertEqual(list(digits.iterparse("12a")), ["1", "2"])
+
+        items = (digit * 3).iterparse("12a")
+        self.assertEqual(next(items), "1")
+        self.assertEqual(next(items), "2")
+        with self.assertRaises(Failure) as raised:
+            next(items)
+        self.assertEqual(raised.exception.start, 2)
+
+        with self.assertRaises(Failure):
+            list((+digit).iterparse("a"))
+
+    def test_feed(self):
+        """ Test parsing input that arrives in chunks. """
+        feeder = FeedParser((word | digits) << exact(";"))
+        self.assertEqual(feeder.feed("ab;1"), ["ab"])
+        self.assertEqual(feeder.feed("2;c"), ["12"])
+        self.assertEqual((feeder.buffer, feeder.offset), ("c", 6))
+        self.assertEqual(feeder.feed(";"), ["c"])
+        self.assertEqual(feeder.close(), [])
+
+        feeder = FeedParser(one_of("123") * 2, [])
+        self.assertEqual(feeder.feed(["1", "2", "3"]), [["1", "2"]])
+        with self.assertRaises(Failure):
+            feeder.close()
+
+        # an item spanning many chunks is not parsed again for every one
+        calls = []
+        item = (one_of("a") // calls.append).many() >> exact(";")
+        feeder = FeedParser(item)
+        values = []
+        for chunk in ["a"] * 1000 + [";", "a;"]:
+            values.extend(feeder.feed(chunk))
+        values.extend(feeder.close())
+        self.assertEqual(values, [";", ";"])
+        self.assertLess(len(calls), 4 * 1000)
+
+        for prsr in [exact("ab"), one_of("ab"), digits, EOF]:
+            compiled = compile_parser(prsr)
+            for text in ["", "a", "ab", "1", "12"]:
+                context = ParseContext(text)
+                prsr._scan(context, 0)
+                expected = context.hit_end
+
+                context = ParseContext(text)
+                compiled._scan(context, 0)
+                self.assertEqual(context.hit_end, expected)
+
+    def test_byte_input(self):
+        """ Test parsing byte arrays, memory views and mapped files. """
+        grammar = word + spaces + digits + exact("\n")
+        text = "abc 12\ndef"
+
+        handle, filename = tempfile.mkstemp()
+        try:
+            os.write(handle, text)
+            os.close(handle)
+
+            with open(filename, "rb") as mapped_file:
+                data = mmap.mmap(mapped_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+                for source in [text, bytearray(text), memoryview(text), data]:
+                    self.assertEqual(grammar.parse(source), "abc 12\n")
+                    self.assertTrue(matches(exact("DEF", True), source, 7))
+
+                    with self.assertRaises(Failure) as raised:
+                        grammar.parse(source, 7)
+                    self.assertEqual(location(raised.exception.text,
+                                              raised.exception.start),
+                                     "2:4")
+
+                data.close()
+        finally:
+            os.remove(filename)
+
+    def test_folded(self):
+        """ Test matching literals against a lower case copy of the input. """
+        text = "End If"
+        grammar = exact("end", True) + spaces + exact("IF", True)
+
+        for variant in [grammar, compile_parser(grammar)]:
+            for folded in [None, text.lower()]:
+                context = ParseContext(text, folded=folded)
+                self.assertEqual(variant.scan(text, 0, context).value,
+                                 "end if")
+                context = ParseContext(text, folded=folded)
+                self.assertIsNone(variant._scan(context, 1))
+
+        self.assertEqual(RawLine("      Double Precision X\n").statement,
+                         "double precision")
+        self.assertEqual(RawLine("      ENDIF\n").statement, "end if")
+        self.assertEqual(RawLine("      X = 1\n").statement, "assignment")
+        self.assertEqual(RawLine(u"      if (a .eq. b) x = 1\n").statement,
+                         "if")
+
+    def test_search(self):
+        """ Test searching for matches anywhere in the input. """
+        text = "x = 10 + call(20)  call"
+
+        self.assertEqual([(found.start, found.end, found.value)
+                          for found in digits.finditer(text)],
+                         [(4, 6, "10"), (14, 16, "20")])
+        self.assertEqual([found.value for found in digits.scan_all(text)],
+                         ["10", "0", "20", "0"])
+        self.assertEqual([found.start for found in
+                          (exact("call") >> exact("(")).finditer(text)], [9])
+        self.assertEqual(exact("call").search(text, 10).start, 19)
+        self.assertIsNone(exact("nope").search(text))
+        self.assertEqual(exact("call").literal_prefix(), "call")
+        self.assertEqual(exact("CALL", True).search(text).start, 9)
+
+        # empty matches, as with regular expressions
+        self.assertEqual([(found.start, found.end)
+                          for found in (~exact("a")).finditer("baa")],
+                         [(0, 0), (1, 3), (3, 3)])
+
+        tokens = [Token("name", "x"), Token("op", "="), Token("name", "y")]
+        self.assertEqual([found.start for found in
+                          one_of_tags(("name",)).finditer(tokens)], [0, 2])
+        self.assertEqual([found.value for found in
+                          one_of("ab").finditer(bytearray("xaxb"))],
+                         ["a", "b"])
+
+    def test_context(self):
+        """ Test sharing the parse state of one input between parsers. """
+        calls = []
+
+        def counted(value):
+            """ Count the applications of the parser. """
+            calls.append(value)
+            return value
+
+        item = (word // counted).memoize()
+        grammar = (item + exact("!")) | (item + exact("?"))
+
+        @parser
+        def nested(text, start, context):
+            """ Apply `grammar` as part of the enclosing parse. """
+            return grammar.scan(text, start, context)
+
+        for test in [grammar, nested, compile_parser(grammar)]:
+            del calls[:]
+            context = ParseContext("ab?")
+            self.assertEqual(test.parse("ab?", 0, context), "ab?")
+            self.assertEqual(calls, ["ab"])
+
+            with self.assertRaises(Failure):
+                test.scan("ab.", 0, ParseContext("ab."))
+            self.assertEqual(calls, ["ab", "ab"])
+
+        texts = ["{}!".format("x" * size) for size in range(1, 50)]
+        results = []
+
+        def run():
+            """ Parse the texts with the shared parser. """
+            results.append([grammar.parse(text) for text in texts])
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [texts] * 4)
+
+    def test_cut(self):
+        """ Test cuts and choices without backtracking. """
+        committed = (exact("a") & exact("b")) | exact("ac")
+        self.match(committed, "ab", "ab", 2)
+        self.mismatch(committed, "ac", repr("b"), 1)
+        self.match(committed % "pair" | exact("a"), "ac", "a", 1)
+
+        repeated = ((exact("a") & exact("b")) | exact("x")).many()
+        self.match(repeated, "abxa!", ["ab", "x"], 3)
+        self.mismatch((exact("a") & exact("b")).many(), "aba!", repr("b"), 3)
+        self.mismatch((exact("a") & exact("b")).memoize().many(), "aba!",
+                      repr("b"), 3)
+
+        no_backtrack = (exact("a") + exact("b")) ^ exact("ac") ^ exact("x")
+        self.match(no_backtrack, "x", "x", 1)
+        self.mismatch(no_backtrack, "ac", repr("b"), 1)
+
+        for test in [committed, committed % "pair" | exact("a"), repeated,
+                     (exact("a") & exact("b")).many(), no_backtrack]:
+            compiled = compile_parser(test)
+            optimized = optimize(test)
+            for text in ["ab", "ac", "x", "abxa!", "aba!"]:
+                self.assertEqual(matches(test, text), matches(compiled, text))
+                self.assertEqual(matches(test, text), matches(optimized, text))
+
+        # a cut stays within the labelled choice it was made in
+        test = committed % "pair" | exact("a")
+        self.assertTrue(matches(optimize(test), "ac"))
+        self.match(optimize(test), "ac", "a", 1)
+
+        # the results memoized before a cut are released
+        item = word.memoize()
+        for test, size in [(+(item & exact(";")), 1),
+                           (+(item + exact(";")), 4)]:
+            for variant in [test, compile_parser(test), iterative(test)]:
+                context = ParseContext("ab;cd;ef;")
+                self.assertEqual(variant.parse("ab;cd;ef;", 0, context),
+                                 ["ab;", "cd;", "ef;"])
+                self.assertEqual(len(context.memo), size)
+
+    def test_budget(self):
+        """ Test the limits on the work spent on a parse. """
+        grammar = ((word + exact("!")) | (word + exact("?"))).many()
+        text = "abc! abcdef? x?"
+
+        for test in [grammar, compile_parser(grammar)]:
+            budget = ParseBudget(max_steps=20)
+            self.assertEqual(test.parse(text, 0, ParseContext(text, budget)),
+                             ["abc!"])
+            self.assertEqual(budget.steps, 3)
+
+            with self.assertRaises(ParseBudgetExceeded) as raised:
+                context = ParseContext(text, ParseBudget(max_steps=5))
+                (test << spaces).many().parse(text, 0, context)
+            self.assertEqual((raised.exception.limit, raised.exception.start),
+                             ("steps", 5))
+
+            with self.assertRaises(ParseBudgetExceeded) as raised:
+                context = ParseContext(text, ParseBudget(max_backtrack=3))
+                (test << spaces).many().parse(text, 0, context)
+            self.assertEqual((raised.exception.limit, raised.exception.start),
+                             ("backtrack", 5))
+            self.assertIn("backtrack", str(raised.exception))
+
+            budget = ParseBudget(timeout=-1)
+            budget.clock_interval = 1
+            with self.assertRaises(ParseBudgetExceeded) as raised:
+                test.parse(text, 0, ParseContext(text, budget))
+            self.assertEqual(raised.exception.limit, "deadline")
+
+        raw_lines = [RawLine(line) for line in ["c comment\n", "      x = 1\n",
+                                                "     +    + 2\n",
+                                                "      y = 3\n"]]
+        lines = parse_into_logical_lines(raw_lines)
+        self.assertEqual([line_number(raw_lines, lines, index)
+                          for index in range(3)], [2, 4, 4])
+
+        with self.assertRaises(ParseBudgetExceeded) as raised:
+            parse_source(lines, ParseBudget(max_steps=1))
+        self.assertIn("at line 2 ", raised.exception.explain(
+            lambda index: "line {}".format(line_number(
+                raw_lines, raised.exception.text, index))))
+
+    def test_profile(self):
+        """ Test the statistics collected for each named parser. """
+        scan = ExactParser.__dict__["_scan"]
+        number = digits % "number"
+        grammar = ((number + exact("!")) | (number + exact("?"))).many()
+
+        with Profiler() as profiler:
+            self.assertEqual(grammar.parse("12?3!"), ["12?", "3!"])
+
+        self.assertIs(ExactParser.__dict__["_scan"], scan)
+
+        stats = profiler.stats["number"]
+        self.assertEqual((stats.calls, stats.successes, stats.failures),
+                         (3, 3, 0))
+        self.assertEqual(stats.consumed, 5)
+        self.assertEqual(profiler.stats[repr("!")].calls, 2)
+        self.assertEqual(profiler.stats[repr("!")].backtracks, 0)
+        self.assertIn("number", profiler.report())
+
+        # combinators applied by the engine are profiled too
+        nested = iterative(~exact("a") % "many a" + exact("!"))
+        with Profiler() as profiler:
+            self.assertEqual(iterative(grammar).parse("12?3!"),
+                             ["12?", "3!"])
+            with self.assertRaises(ParseBudgetExceeded):
+                nested.parse("a!", 0,
+                             ParseContext("a!", ParseBudget(max_steps=0)))
+
+        self.assertEqual(profiler.stats["number"].calls, 3)
+        self.assertEqual(profiler.stats["many a"].active, 0)
+        self.assertEqual(profiler.children, [])
+
+    def test_rule(self):
+        """ Test recursive grammars of named rules. """
+        expr = Rule("expr")
+        term = (digits | exact("(") >> expr << exact(")")) // singleton
+        expr <<= term + (~(exact("+") >> term) // concat)
+
+        self.assertEqual(expr.parse("1+(2+3)+4"), ["1", ["2", "3"], "4"])
+        self.assertEqual(expr.first(), (frozenset("0123456789("), False))
+        with self.assertRaises(Failure) as failure:
+            expr.scan("(1")
+        self.assertEqual(failure.exception.furthest, 2)
+
+        for variant in [optimize(expr), compile_parser(expr)]:
+            self.assertEqual(variant.parse("(1+(2))+3"), [["1", ["2"]], "3"])
+            with self.assertRaises(Failure):
+                variant.scan("(1")
+
+        nested = Rule("nested")
+        nested <<= -(exact("[") + nested + exact("]")) // join
+        self.assertEqual(nested.first(), (frozenset("["), True))
+        self.assertEqual(nested.parse("[[]]"), "[[]]")
+
+        undefined = Rule("undefined")
+        with self.assertRaises(ValueError):
+            undefined.parse("")
+        with self.assertRaises(ValueError):
+            expr.define(term)
+
+    def test_iterative(self):
+        """ Test applying parsers without Python recursion. """
+        expr = Rule("expr")
+        term = (digits | exact("(") >> expr << exact(")")) // singleton
+        expr <<= term + (~(exact("+") >> term) // concat)
+
+        deep = "(" * 2000 + "1" + ")" * 2000
+        with self.assertRaises(RuntimeError):
+            expr.parse(deep)
+        self.assertEqual(iterative(expr).scan(deep).end, len(deep))
+
+        grammar = (exact("a") & (exact("b") | exact("c")) |
+                   exact("d").memoize() + exact("!") |
+                   exact("d") % "dee").many()
+        for text in ["ab", "acd!d", "ad", "ddx", "d!ax"]:
+            try:
+                expected = grammar.scan(text)
+            except Failure as failure:
+                with self.assertRaises(Failure) as other:
+                    iterative(grammar).scan(text)
+                self.assertEqual(other.exception.start, failure.start)
+                self.assertEqual(other.exception.expected, failure.expected)
+            else:
+                success = iterative(grammar).scan(text)
+                self.assertEqual((success.end, success.value),
+                                 (expected.end, expected.value))
+
+    def test_lexer(self):
+        """ Test the regular expression lexer and token combinators. """
+        lexer = Lexer([("number", "[0-9]+"), ("name", "[a-z]+"),
+                       ("space", " +")], convert={"number": int})
+
+        tokens = lexer.parse("ab 12 c?")
+        self.assertEqual([(token.tag, token.value) for token in tokens],
+                         [("name", "ab"), ("space", " "), ("number", 12),
+                          ("space", " "), ("name", "c")])
+        self.assertEqual(lexer.scan("ab 12 c?").end, 7)
+        self.assertEqual(lexer.parse("ab cd", 3)[0].value, "cd")
+        self.assertEqual(repr(tokens[2]), "number{12}")
+
+        tokens = [Token("name", "x"), Token("op", "="), Token("number", 1),
+                  Token("op", "+"), Token("name", "y")]
+        operand = one_of_tags(("name", "number"))
+        pairs = (operand // singleton +
+                 none_of_tags(("name",)) // singleton).many()
+        self.assertEqual(pairs.scan(tokens).end, 4)
+        self.mismatch(one_of_tags(("op",)), tokens, "one of op")
+
+        value = switch_tag({"name": succeed("variable") << wildcard,
+                            "number": succeed("constant") << wildcard})
+        self.assertEqual(separated_by(value, one_of_tags(("op",)))
+                         .parse(tokens), ["variable", "constant", "variable"])
+        self.assertEqual(switch_tag({}, wildcard).parse(tokens), tokens[0])
+        with self.assertRaises(Failure):
+            switch_tag({"op": wildcard}).scan(tokens)
+
+    def test_tokenizer(self):
+        """ Test that the Fortran lexer agrees with the token parsers. """
+        corpus = ["  program ancient\n",
+                  "  if (x .eq. 5) print *, 'all is well'\n",
+                  "  do i=1,18 ! let's do the indentation wrong\n",
+                  "x = 1.5d0 + .TRUE. .and. 3e-2 // 'it''s' // \"q\"\n",
+                  "if (a .LE. b .neqv. c) x=y**2*z/w - +4. $ : < > . & #\n",
+                  "call f(1.e5, 2D+3, -7, abc12, 1.) ! done\n",
+                  "\t  \x0c  x = 'open", "",
+                  u"if (a .EQ. b) x = 1\n", u"\xe9dee = \u0663 + 1.5D0\n",
+                  u"x = 'caf\xe9' ! \u00a0note\n"]
+        for code in corpus:
+            self.assertEqual([(token.tag, token.value) for token
+                              in Grammar.tokenizer.parse(code)],
+                             [(token.tag, token.value) for token
+                              in Grammar.single_token.many().parse(code)])
+
+    def test_operators(self):
+        """ Test expressions parsed by operator precedence. """
+        minus = exact("-")
+        arithmetic = operators(digits, prefix=[(minus, 20)],
+                               infix=[(exact("+"), 10), (minus, 10),
+                                      (exact("*"), 30)],
+                               right=[(exact("**"), 40)])
+
+        self.match(arithmetic, "1-2-3", ("-", ("-", "1", "2"), "3"))
+        self.match(arithmetic, "1+2*3**4**5",
+                   ("+", "1", ("*", "2", ("**", "3", ("**", "4", "5")))))
+        self.match(arithmetic, "-1+2", ("+", ("-", "1"), "2"))
+        self.match(arithmetic, "-1*2", ("-", ("*", "1", "2")))
+        self.match(arithmetic, "1*2+", ("*", "1", "2"), 3)
+        self.mismatch(arithmetic, "+1", "digits")
+        self.assertEqual(arithmetic.first(),
+                         (frozenset("-0123456789"), False))
+
+        self.assertEqual(repr(Grammar.expression.parse("-x(i)**2 .GE. 1")),
+                         "('.ge.', ('-', ('**', ('()', name{x}, [name{i}]), "
+                         "integer{2})), integer{1})")
+
+    def test_lint(self):
+        """ Test the warnings about problematic grammars. """
+        def kinds(prsr):
+            """ The kinds of the findings about `prsr`. """
+            return set(finding.kind for finding in lint(prsr))
+
+        self.assertIn("nullable repetition", kinds((~digits).many()))
+        self.assertIn("shadowed", kinds(exact("end") | exact("end if")))
+        self.assertNotIn("shadowed", kinds(exact("end if") | exact("end")))
+        self.assertEqual(kinds(digits.many()), set())
+
+        def nested(memoize):
+            """ A grammar with nested parentheses, memoized if `memoize`. """
+            expr = Rule("expr")
+            body = (digits | exact("(") >> expr << exact(")") |
+                    exact("(") >> digits)
+            expr.define(body.memoize() if memoize else body)
+            return expr
+
+        self.assertEqual(backtracking_depth(nested(False)), float('inf'))
+        self.assertEqual(backtracking_depth(nested(True)), 1)
+        self.assertIn("backtracking", [finding.kind for finding
+                                       in lint(nested(False), max_depth=2)])
+
+        for prsr in [Grammar.single_token, Grammar.expression,
+                     Grammar.statement_keyword,
+                     block_parser(), program_unit_parser(),
+                     logical_line_parser()]:
+            self.assertFalse(kinds(prsr) & {"nullable repetition",
+                                            "shadowed"})
+        self.assertLess(backtracking_depth(block_parser(memo=Memo())),
+                        float('inf'))
+
+    def test_snapshot(self):
+        """ Test pickling parsers and saving them as snapshots. """
+        expr = Rule("expr")
+        term = (bracketed | digits | exact("(") >> expr << exact(")") |
+                satisfies(str.isalpha, "letter")) // singleton
+        expr <<= term + (~(exact("+") >> term) // concat)
+
+        for variant in [expr, expr.memoize(Memo(10)), compile_parser(expr)]:
+            for copy in [pickle.loads(pickle.dumps(variant, 2)),
+                         snapshot.loads(snapshot.dumps(variant))]:
+                self.assertIs(type(copy), type(variant))
+                self.assertEqual(copy.parse("[1]+(2+x)"),
+                                 ["1", ["2", "x"]])
+
+        directory = tempfile.mkdtemp()
+        try:
+            source = os.path.join(directory, "source.f")
+            with open(source, "w") as source_file:
+                source_file.write("      program p\n"
+                                  "      double precision x\n"
+                                  "      if (x .gt. 0) then\n"
+                                  "        do i = 1, 2\n"
+                                  "        end do\n"
+                                  "      end if\n"
+                                  "      end\n")
+            lines = parse_into_logical_lines(read_file(source))
+
+            path = os.path.join(directory, "units")
+            snapshot.save(program_unit_parser(), path)
+            units = snapshot.load(path)
+        finally:
+            shutil.rmtree(directory)
+
+        memo = Memo(10)
+        block_parser(memo=memo).parse(lines)
+        self.assertGreater(len(memo), 0)
+        self.assertEqual(len(pickle.loads(pickle.dumps(memo))), 0)
+
+        self.assertEqual(repr(OuterBlock((+units).parse(lines), "source")),
+                         repr(OuterBlock((+program_unit_parser())
+                                         .parse(lines), "source")))
+
+        with self.assertRaises(snapshot.SnapshotError):
+            snapshot.loads(pickle.dumps(expr))
+
+    def test_benchmark(self):
+        """ Test the benchmarks and the detection of regressions. """
+        for bench in benchmarks():
+            bench.check(bench.text(10))
+
+        previous = {"many": {"10": {"ops_per_sec": 100.0, "allocations": 4}},
+                    "map": {"10": {"ops_per_sec": 100.0, "allocations": 4}}}
+        current = {"many": {"10": {"ops_per_sec": 90.0, "allocations": 4},
+                            "1000": {"ops_per_sec": 0.01,
+                                     "allocations": 4}},
+                   "map": {"10": {"ops_per_sec": 50.0, "allocations": 9}}}
+
+        self.assertEqual(len(regressions(previous, current, 1.25)), 2)
+        self.assertEqual(superlinear(current, 3.0), ["many"])
+
 
 if __name__ == '__main__':
     unittest.main()
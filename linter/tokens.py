@@ -3,93 +3,499 @@ Some lowest-level parsers, that is, tokenizers.
 """
 import re
 
-from .parsers import parser, join
-from .parsers import Success, Failure
+from .parsers import AbstractParser, singleton, interned, choice_first
+from .parsers import BYTE_TYPES
 
 
-def exact(string, ignore_case=False):
-    """ Only matches the exact `string`. """
-    if ignore_case:
-        string = string.lower()
+class ExactParser(AbstractParser):
+    """ Only matches the exact `string`, possibly ignoring case. """
+    def __init__(self, string, ignore_case=False):
+        if ignore_case:
+            string = string.lower()
 
-    @parser(repr(string))
-    def inner(text, start):
-        """ A parser for the `string`. """
-        whole = len(string)
+        self.string = string
+        self.ignore_case = ignore_case
+        self.expected = repr(string)
 
-        segment = text[start: start + whole]
-        if ignore_case:
-            segment = segment.lower()
+    def _scan(self, context, start):
+        string = self.string
+        end = start + len(string)
+
+        if not self.ignore_case:
+            matched = context.text[start: end] == string
+        elif context.folded is not None:
+            matched = context.folded.startswith(string, start)
+        else:
+            matched = context.text[start: end].lower() == string
+
+        if matched:
+            return end, string
+        else:
+            if end > len(context.text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        # both cases of the first letter when ignoring case
+        string = self.string
+        if string == "":
+            return frozenset(), True
+        elif self.ignore_case:
+            return frozenset([string[0], string[0].upper()]), False
+        else:
+            return frozenset([string[0]]), False
+
+    def literal_prefix(self):
+        return "" if self.ignore_case else self.string
+
+
+class SatisfiesParser(AbstractParser):
+    """ Recognizes a character satisfying given `predicate`. """
+    def __init__(self, predicate, desc):
+        self.predicate = predicate
+        self.expected = desc
+
+    def _scan(self, context, start):
+        text = context.text
+
+        if start < len(text) and self.predicate(text[start]):
+            return start + 1, text[start]
+        else:
+            if start >= len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        return None, False
+
+
+class OneOfParser(AbstractParser):
+    """ Recognizes any of the given characters `chars`. """
+    def __init__(self, chars):
+        self.chars = chars
+        self.expected = "one of {}".format(chars)
+
+    def _scan(self, context, start):
+        text = context.text
 
-        if segment == string:
-            return Success(text, start, start + whole, string)
+        if start < len(text) and text[start] in self.chars:
+            return start + 1, text[start]
+        else:
+            if start >= len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        return frozenset(self.chars), False
+
+
+class NoneOfParser(AbstractParser):
+    """ Consumes a character that is not on the list `chars`. """
+    def __init__(self, chars):
+        self.chars = chars
+        self.expected = "none of {}".format(chars)
+
+    def _scan(self, context, start):
+        text = context.text
+
+        if start < len(text) and text[start] not in self.chars:
+            return start + 1, text[start]
+        else:
+            if start >= len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        return None, False
+
+
+class RegexParser(AbstractParser):
+    """ Matches the compiled regular expression `exp`. """
+    def __init__(self, exp):
+        self.exp = exp
+        self.expected = None
+
+    def _scan(self, context, start):
+        text = context.text
+        match = self.exp.match(text, start)
+
+        if match:
+            if match.end() == len(text):
+                context.hit_end = True
+            return match.end(), match
+        else:
+            # there is no telling how far the expression looked
+            context.hit_end = True
+            return context.fail(start, self.exp.pattern)
+
+
+class SpanParser(AbstractParser):
+    """
+    Consumes the run of characters matched by the compiled regular
+    expression `exp` in one step, and returns it as a string. The run is
+    at least `minimum` and at most `maximum` characters long, if known.
+
+    Only byte strings and buffers are matched with `exp`. Other input, such
+    as unicode strings or lists, is tested item by item with `predicate`, or
+    with the regular expression `member` of a single character if there is
+    none.
+    """
+    def __init__(self, exp, desc, chars=None, minimum=None, maximum=None,
+                 member=None, predicate=None):
+        self.exp = exp
+        self.expected = desc
+        self.chars = chars
+        self.minimum = minimum
+        self.maximum = maximum
+        self.member = member
+        self.predicate = predicate
+
+    def _scan(self, context, start):
+        text = context.text
+        if not isinstance(text, BYTE_TYPES):
+            return self.scan_items(context, start)
+
+        match = self.exp.match(text, start)
+
+        if match:
+            end = match.end()
+            if end == len(text):
+                context.hit_end = True
+            return end, match.group()
+        else:
+            # the run might have been cut short by the end
+            minimum = self.minimum
+            if minimum is None or start + minimum > len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def scan_items(self, context, start):
+        """ Consume the run one item at a time. """
+        text = context.text
+        test = self.predicate or self.member.match
+
+        limit = len(text)
+        if self.maximum is not None:
+            limit = min(limit, start + self.maximum)
+
+        end = start
+        while end < limit and test(text[end]):
+            end += 1
+
+        if end == len(text):
+            context.hit_end = True
+
+        if end - start < (self.minimum or 0):
+            return context.fail(start, self.expected)
+
+        value = text[start:end]
+        if not isinstance(value, basestring):
+            value = "".join(value)
+        return end, value
+
+    def first(self):
+        return self.chars, self.exp.match("") is not None
+
+
+class Token(object):
+    """ A piece of text `value` classified as `tag`. """
+    __slots__ = ('tag', 'value')
+
+    def __init__(self, tag, value):
+        self.value = value
+        self.tag = tag
+
+    def __repr__(self):
+        return "{}{{{}}}".format(self.tag, self.value)
+
+
+class Lexer(AbstractParser):
+    """
+    Splits text into a list of :class:`Token` objects by an ordered list of
+    ``(tag, pattern)`` `rules`, compiled with `flags` into one regular
+    expression of alternatives named by the tags. At each position the
+    first rule that matches wins, as in a choice, and lexing stops where
+    none does. Patterns should not match the empty string. The text of the
+    tokens of the tags in the dictionary `convert` is passed through the
+    function found there. Input other than byte strings and buffers is left
+    to the parser `fallback` if given, such as the token parsers the rules
+    were written from, whose character tests the patterns may not match.
+    """
+    def __init__(self, rules, flags=0, convert=None, fallback=None):
+        self.rules = rules
+        self.exp = re.compile("|".join("(?P<{}>{})".format(tag, pattern)
+                                       for tag, pattern in rules), flags)
+        self.convert = convert or {}
+        self.fallback = fallback
+        self.expected = None
+
+    def _scan(self, context, start):
+        if (self.fallback is not None and
+                not isinstance(context.text, BYTE_TYPES)):
+            return self.fallback._scan(context, start)
+
+        convert = self.convert
+        match = self.exp.scanner(context.text, start).match
+
+        tokens = []
+        end = start
+
+        while True:
+            found = match()
+            if found is None or found.end() == end:
+                break
+
+            tag, value = found.lastgroup, found.group()
+            if tag in convert:
+                value = convert[tag](value)
+
+            tokens.append(Token(tag, value))
+            end = found.end()
+
+        # there is no telling how far the expression looked
+        context.hit_end = True
+        return end, tokens
+
+
+class OneOfTagsParser(AbstractParser):
+    """
+    Recognizes an item, such as a :class:`Token`, whose attribute `attr`
+    is one of `tags`, with a set lookup.
+    """
+    def __init__(self, tags, desc, attr):
+        self.tags = frozenset(tags)
+        self.expected = desc
+        self.attr = attr
+
+    def _scan(self, context, start):
+        text = context.text
+
+        if start < len(text) and getattr(text[start], self.attr) in self.tags:
+            return start + 1, text[start]
+        else:
+            if start >= len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        return None, False
+
+
+class NoneOfTagsParser(AbstractParser):
+    """
+    Consumes an item whose attribute `attr` is none of `tags`, with a set
+    lookup.
+    """
+    def __init__(self, tags, desc, attr):
+        self.tags = frozenset(tags)
+        self.expected = desc
+        self.attr = attr
+
+    def _scan(self, context, start):
+        text = context.text
+
+        if (start < len(text) and
+                getattr(text[start], self.attr) not in self.tags):
+            return start + 1, text[start]
         else:
-            raise Failure(text, start, repr(string))
+            if start >= len(text):
+                context.hit_end = True
+            return context.fail(start, self.expected)
+
+    def first(self):
+        return None, False
+
+
+class SwitchTagParser(AbstractParser):
+    """
+    Applies the parser that the dictionary `cases` has for the attribute
+    `attr` of the next item, or `default` if there is none there (or at the
+    end of input). Fails if there is no parser to apply either.
+    """
+    def __init__(self, cases, default, attr):
+        self.cases = cases
+        self.default = default
+        self.attr = attr
+        self.expected = "one of {}".format(", ".join(sorted(cases)))
+
+    def _scan(self, context, start):
+        text = context.text
+
+        if start < len(text):
+            this = self.cases.get(getattr(text[start], self.attr),
+                                  self.default)
+        else:
+            context.hit_end = True
+            this = self.default
+
+        if this is None:
+            return context.fail(start, self.expected)
+
+        return this._scan(context, start)
+
+    def first(self):
+        parsers = list(self.cases.values())
+        if self.default is not None:
+            parsers.append(self.default)
+
+        # the items are not characters
+        return None, choice_first(parsers)[1]
 
-    return inner
+
+@interned
+def exact(string, ignore_case=False):
+    """ Only matches the exact `string`. """
+    return ExactParser(string, ignore_case)
 
 
+@interned
 def satisfies(predicate, desc):
     """ Recognize a character satisfying given `predicate`. """
-    @parser(desc)
-    def inner(text, start):
-        """ A parser that applies the `predicate`. """
-        if start < len(text) and predicate(text[start]):
-            return Success(text, start, start + 1, text[start])
-        else:
-            raise Failure(text, start, desc)
-    return inner
+    return SatisfiesParser(predicate, desc)
+
 
+@interned
+def span(chars, desc, minimum=1, maximum=None, predicate=None):
+    """
+    Consume the longest run of characters in the regular expression
+    character class `chars`, at least `minimum` and at most `maximum`
+    of them. Input other than byte strings is tested a character at a time,
+    with `predicate` if given, which should agree with `chars` on bytes.
+    """
+    exp = re.compile("{}{{{},{}}}".format(chars, minimum,
+                                          "" if maximum is None else maximum))
 
+    return SpanParser(exp, desc, class_members(chars), minimum, maximum,
+                      re.compile(chars), predicate)
+
+
+def class_members(chars):
+    """
+    The set of characters in the regular expression character class
+    `chars`, if it is a (non-negated) set of byte characters. Otherwise
+    `None`, as it could be arbitrarily large.
+    """
+    if (not isinstance(chars, str) or not chars.startswith("[") or
+            chars.startswith("[^")):
+        return None
+
+    exp = re.compile(chars)
+    return frozenset(char for char in map(chr, range(256)) if exp.match(char))
+
+
+@interned
 def one_of(chars):
     """ Recognize any of the given characters `chars`. """
-    return satisfies(lambda c: c in chars, "one of {}".format(chars))
+    return OneOfParser(chars)
 
 
+@interned
 def none_of(chars):
     """ Consumes a character that is not on the list `chars`. """
-    return satisfies(lambda c: c not in chars, "none of {}".format(chars))
+    return NoneOfParser(chars)
+
+
+def anything(_):
+    """ The predicate of :data:`wildcard`, true of any character. """
+    return True
 
 
 #: succeeds for any character
-wildcard = satisfies(lambda c: True, "")
+wildcard = satisfies(anything, "")
+
+#: character classes for :func:`span`, agreeing with the ``str`` methods
+#: `isspace`, `isalpha`, `isdigit` and `isalnum`
+space_chars = r"[ \t\n\r\x0b\x0c]"
+letter_chars = "[a-zA-Z]"
+digit_chars = "[0-9]"
+alphanumeric_chars = "[a-zA-Z0-9]"
+
+
+def is_space(char):
+    """ Whether `char` is whitespace, unicode or not. """
+    return char.isspace()
+
+
+def is_letter(char):
+    """ Whether `char` is a letter, unicode or not. """
+    return char.isalpha()
+
+
+def is_digit(char):
+    """ Whether `char` is a digit, unicode or not. """
+    return char.isdigit()
+
+
+def is_alphanumeric(char):
+    """ Whether `char` is a letter or a digit, unicode or not. """
+    return char.isalnum()
+
 
 #: matches a space character
-space = satisfies(lambda c: c.isspace(), "whitespace")
+space = span(space_chars, "whitespace", 1, 1, is_space)
 
 #: matches whitespace
-spaces = (+space // join) % "whitespaces"
+spaces = span(space_chars, "whitespaces", 1, None, is_space)
 
 #: matches optional whitespace
-whitespace = (~space // join) % "optional whitespace"
+whitespace = span(space_chars, "optional whitespace", 0, None, is_space)
 
 #: matches a letter
-letter = satisfies(lambda c: c.isalpha(), "letter")
+letter = span(letter_chars, "letter", 1, 1, is_letter)
 
 #: matches a word
-word = (+letter // join) % "word"
+word = span(letter_chars, "word", 1, None, is_letter)
 
 #: matches a digit
-digit = satisfies(lambda c: c.isdigit(), "digit")
+digit = span(digit_chars, "digit", 1, 1, is_digit)
 
 #: matches a list of digits
-digits = (+digit // join) % "digits"
+digits = span(digit_chars, "digits", 1, None, is_digit)
 
 #: matches one alphanumeric character
-alphanumeric = satisfies(lambda c: c.isalnum(), "alphanumeric")
+alphanumeric = span(alphanumeric_chars, "alphanumeric", 1, 1,
+                    is_alphanumeric)
 
 #: matches multiple alphanumeric characters
-alphanumerics = (+alphanumeric // join) % "alphanumerics"
+alphanumerics = span(alphanumeric_chars, "alphanumerics", 1, None,
+                     is_alphanumeric)
+
+
+@interned
+def one_of_tags(tags, desc=None, attr="tag"):
+    """
+    Recognize an item whose attribute `attr` is one of `tags`, described
+    as `desc`.
+    """
+    if desc is None:
+        desc = "one of {}".format(", ".join(tags))
+
+    return OneOfTagsParser(tags, desc, attr)
+
+
+@interned
+def none_of_tags(tags, desc=None, attr="tag"):
+    """
+    Consume an item whose attribute `attr` is none of `tags`, described
+    as `desc`.
+    """
+    if desc is None:
+        desc = "none of {}".format(", ".join(tags))
+
+    return NoneOfTagsParser(tags, desc, attr)
+
+
+def switch_tag(cases, default=None, attr="tag"):
+    """
+    Look up the parser to apply in the dictionary `cases` by the attribute
+    `attr` of the next item, falling back to `default`.
+    """
+    return SwitchTagParser(cases, default, attr)
 
 
 def separated_by(prsr, sep, empty=None):
     """ A list of `prsr` parsers separated by `sep` parsers. """
-    @parser
-    def inner(text, start):
-        """ A parser that returns the list of values parsed by `prsr`. """
-        head = prsr.scan(text, start)
-        tail = (~(sep >> prsr)).scan(text, head.end)
-        return Success(text, start, tail.end, [head.value] + tail.value)
+    inner = prsr // singleton + ~(sep >> prsr)
 
     if empty is None:
         return inner
@@ -107,13 +513,4 @@ def regex(exp, flags=0):
     if isinstance(exp, str):
         exp = re.compile(exp, flags)
 
-    @parser
-    def inner(text, start):
-        """ A parser that applies the regex. """
-        match = exp.match(text, start)
-
-        if match:
-            return Success(text, match.start(), match.end(), match)
-        else:
-            raise Failure(text, start, exp.pattern)
-    return inner
+    return RegexParser(exp)